@@ -1,11 +1,29 @@
-''' Grabbed from Angel Audiopoof. Could probably be made less janky.
-''' 
+''' Grabbed from Angel Audiopoof, reworked to use pyaudio's callback mode.
+
+Audio comes from a pluggable source, set with the 'source' config param: 'mic' records with pyaudio, 'wav' plays a
+16 bit WAV file and 'generated' makes a click track at a set tempo. The file and generated sources run at
+'speed' times real time, or as fast as the analysis keeps up with when speed is 0, so audio inputs can be tried
+and benchmarked without a mic or pyaudio. They have to be asked for, the default is always 'mic', and without
+pyaudio a mic input fails with a ValueError when it's made, so nothing pulses from audio that isn't there.
+
+Every source hands its chunks to receiveChunk. That only copies the chunk into a preallocated ring buffer
+(numpy.frombuffer, no unpacking) and wakes the analysis thread, which works through every chunk in the ring: an
+rfft of the windowed samples, and the energy of each log spaced band summed from the fft bins with one
+numpy.add.reduceat. The pulse fires when the chunk's level goes over the threshold, and each band gets a value
+outParam with its level(0-100, relative to a slowly decaying peak for that band).
+If analysis falls more than a ring behind a live source, the oldest chunks are skipped and counted as overruns.
+File and generated sources wait for room in the ring instead.
+
+OnsetDetector finds beats from the spectral flux(how much the spectrum grew since the last chunk) against an
+adaptive threshold of the recent median flux. Each onset fires the beat pulse, and the tempo value is estimated
+from the autocorrelation of the last few seconds of flux.
+'''
 from InputBase import InputBase
 
 from threading import Thread, Event
-import time
-import sys
-import struct
+from collections import deque
+from timeit import default_timer
+import wave
 
 
 inputTypes = {
@@ -13,90 +31,325 @@ inputTypes = {
 		'longDescription' : 'Audio responsive pulse input',
 		'shortDescription' : 'Audio Pulse',
 		'inParams' : [{'type' : 'value', 'description' : 'Threshold', 'default' : 1000, 'min' : 1000, 'max' : 10000}],
-		'outParams' : [{'type' : 'pulse', 'sendMessageOnChange' : True}],
+		'outParams' : [
+			{'type' : 'pulse', 'sendMessageOnChange' : True},
+			{'type' : 'pulse', 'description' : 'Beat', 'sendMessageOnChange' : True},
+			{'type' : 'value', 'description' : 'Tempo(bpm)', 'min' : 0, 'max' : 300}
+		],
+		'source' : 'mic', # mic, wav or generated
+		'wavFile' : '',
+		'speed' : 1, # times real time for wav and generated sources, 0 runs as fast as analysis allows
+		'generatedBpm' : 120,
+		'generatedSeconds' : 0, # 0 runs forever
+		'chunk' : 1024,
+		'channels' : 1,
+		'rate' : 22500,
+		'numBands' : 8,
+		'ringChunks' : 16,
+		'bandPeakDecay' : 0.995, # per chunk
+		'onsetThresholdRatio' : 1.5,
+		'minOnsetInterval' : 100, # ms
+		'setupParamsNeeded' : [['text', 'Source(mic, wav or generated)', 'source'], ['text', 'WAV file', 'wavFile'], ['int', 'Speed(times real time, 0 is as fast as possible)', 'speed'], ['int', 'Generated tempo(bpm)', 'generatedBpm']],
 		'hasOwnClass' : True
 	}
 }
 
-	
+
 try:
-	import pyaudio
-	import numpy 
+	import numpy
 except:
 	inputTypes['audio pulse']['unavailable'] = True
 
+try:
+	import pyaudio
+except:
+	pyaudio = False
+
+def makeBandEdges(numBins, numBands):
+	'''Log spaced fft bin indices where each band starts, skipping the dc bin'''
+	return numpy.unique(numpy.geomspace(1, numBins, numBands + 1).astype(int)[:-1])
+
+
+class MicSource():
+	live = True
+	def __init__(self, configParams, receiveChunk):
+		if not pyaudio:
+			raise ValueError('the mic audio source needs pyaudio, which is not installed')
+		self.receiveChunk = receiveChunk
+		self.rate = configParams['rate']
+		self.channels = configParams['channels']
+		self.p = pyaudio.PyAudio()
+		self.stream = self.p.open(
+			format = pyaudio.paInt16,
+			channels = self.channels,
+			rate = self.rate,
+			input = True,
+			frames_per_buffer = configParams['chunk'],
+			stream_callback = self.streamCallback,
+			start = False
+		)
+
+	def streamCallback(self, inData, frameCount, timeInfo, status):
+		self.receiveChunk(inData)
+		return (None, pyaudio.paContinue)
+
+	def start(self):
+		self.stream.start_stream()
+
+	def stop(self):
+		self.stream.stop_stream()
+		self.stream.close()
+		self.p.terminate()
+
+
+class PacedSource(Thread):
+	'''Base for sources that make their own chunks, paced at speed times real time'''
+	live = False
+	def __init__(self, configParams, receiveChunk):
+		Thread.__init__(self)
+		self.daemon = True
+		self.receiveChunk = receiveChunk
+		self.chunk = configParams['chunk']
+		self.speed = float(configParams['speed'])
+		self.stopEvent = Event()
+		self.finished = Event()
+
+	def run(self):
+		startTime = default_timer()
+		framesSent = 0
+		while not self.stopEvent.isSet():
+			data = self.readChunk(framesSent)
+			if not data:
+				break
+			self.receiveChunk(data)
+			framesSent += self.chunk
+			if self.speed > 0:
+				waitTime = startTime + framesSent / float(self.rate) / self.speed - default_timer()
+				if waitTime > 0:
+					self.stopEvent.wait(waitTime)
+		self.finished.set()
+
+	def stop(self):
+		self.stopEvent.set()
+
+
+class WavSource(PacedSource):
+	def __init__(self, configParams, receiveChunk):
+		PacedSource.__init__(self, configParams, receiveChunk)
+		self.wavFile = wave.open(configParams['wavFile'], 'rb')
+		if not self.wavFile.getsampwidth() == 2:
+			raise ValueError('only 16 bit wav files are supported')
+		self.rate = self.wavFile.getframerate()
+		self.channels = self.wavFile.getnchannels()
+
+	def readChunk(self, position):
+		data = self.wavFile.readframes(self.chunk)
+		chunkBytes = self.chunk * self.channels * 2
+		if data and len(data) < chunkBytes:
+			data += '\0' * (chunkBytes - len(data))
+		return data
+
+	def stop(self):
+		PacedSource.stop(self)
+		self.join(1)
+		self.wavFile.close()
+
+
+class GeneratedSource(PacedSource):
+	'''Click track over quiet noise. clickTimes keeps the time of every click made so far, for measuring detection latency'''
+	def __init__(self, configParams, receiveChunk):
+		PacedSource.__init__(self, configParams, receiveChunk)
+		self.rate = configParams['rate']
+		self.channels = 1
+		self.beatInterval = 60. / max(configParams['generatedBpm'], 1)
+		self.endFrame = int(configParams['generatedSeconds'] * self.rate)
+		self.firstClickTime = 1.5 # gives the adaptive threshold some audio to settle on
+		clickTimes = numpy.arange(int(0.02 * self.rate)) / float(self.rate)
+		self.click = 12000 * numpy.sin(2 * numpy.pi * 1000 * clickTimes) * numpy.exp(-clickTimes / 0.005)
+		self.random = numpy.random.RandomState(0)
+		self.clickTimes = []
+
+	def readChunk(self, position):
+		if self.endFrame and position >= self.endFrame:
+			return ''
+		samples = self.random.normal(0, 200, self.chunk)
+		beatIndex = max(int((float(position - len(self.click)) / self.rate - self.firstClickTime) / self.beatInterval), 0)
+		while True:
+			clickFrame = int((self.firstClickTime + beatIndex * self.beatInterval) * self.rate)
+			if clickFrame >= position + self.chunk:
+				break
+			if clickFrame >= position:
+				self.clickTimes.append(clickFrame / float(self.rate))
+			start = max(clickFrame - position, 0)
+			end = min(clickFrame + len(self.click) - position, self.chunk)
+			if end > start:
+				samples[start:end] += self.click[start + position - clickFrame:end + position - clickFrame]
+			beatIndex += 1
+		return numpy.clip(samples, -32768, 32767).astype(numpy.int16).tostring()
+
+audioSources = {'mic' : MicSource, 'wav' : WavSource, 'generated' : GeneratedSource}
+
+
+class OnsetDetector():
+	def __init__(self, chunkSeconds, thresholdRatio = 1.5, minOnsetInterval = 0.1, historySeconds = 6, thresholdSeconds = 1):
+		self.chunkSeconds = chunkSeconds
+		self.thresholdRatio = thresholdRatio
+		self.minOnsetChunks = max(int(round(minOnsetInterval / chunkSeconds)), 1)
+		self.fluxHistory = numpy.zeros(max(int(historySeconds / chunkSeconds), 8))
+		self.thresholdChunks = max(int(thresholdSeconds / chunkSeconds), 4)
+		self.tempoEveryChunks = max(int(0.5 / chunkSeconds), 1)
+		self.minLag = int(numpy.ceil(60. / 200 / chunkSeconds)) # 200 bpm
+		self.maxLag = int(min(60. / 50 / chunkSeconds, len(self.fluxHistory) / 2)) # 50 bpm
+		lagTempos = 60. / (numpy.arange(self.minLag, self.maxLag + 1) * chunkSeconds)
+		self.lagWeights = numpy.exp(-0.5 * numpy.log2(lagTempos / 120.) ** 2) # favours tempos near 120 bpm, so half and double tempo lose ties
+		self.previousMagnitude = False
+		self.chunkCount = 0
+		self.lastOnsetChunk = -self.minOnsetChunks
+		self.tempo = 0
+
+	def process(self, magnitude):
+		'''Takes the magnitude spectrum of the next chunk, returns True if it holds an onset'''
+		logMagnitude = numpy.log1p(magnitude)
+		flux = 0
+		if self.previousMagnitude is not False:
+			flux = numpy.maximum(logMagnitude - self.previousMagnitude, 0).mean()
+		self.previousMagnitude = logMagnitude
+		historyIndex = self.chunkCount % len(self.fluxHistory)
+		recentIndices = numpy.arange(historyIndex - self.thresholdChunks, historyIndex) % len(self.fluxHistory)
+		threshold = numpy.median(self.fluxHistory[recentIndices]) * self.thresholdRatio + 0.01
+		self.fluxHistory[historyIndex] = flux
+		self.chunkCount += 1
+		if self.chunkCount % self.tempoEveryChunks == 0 and self.chunkCount >= len(self.fluxHistory):
+			self.tempo = self.estimateTempo()
+		if flux > threshold and self.chunkCount > self.thresholdChunks and self.chunkCount - self.lastOnsetChunk >= self.minOnsetChunks:
+			self.lastOnsetChunk = self.chunkCount
+			return True
+		return False
+
+	def estimateTempo(self):
+		flux = numpy.roll(self.fluxHistory, -(self.chunkCount % len(self.fluxHistory)))
+		flux = flux - flux.mean()
+		spectrum = numpy.fft.rfft(flux, 2 * len(flux))
+		autocorrelation = numpy.fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2)[:len(flux)]
+		if self.maxLag <= self.minLag or autocorrelation[0] <= 0:
+			return 0
+		lag = self.minLag + numpy.argmax(autocorrelation[self.minLag:self.maxLag + 1] * self.lagWeights)
+		if autocorrelation[lag] <= 0:
+			return 0
+		if 0 < lag < len(autocorrelation) - 1: # parabolic interpolation between the neighbouring lags
+			before, peak, after = autocorrelation[lag - 1:lag + 2]
+			divisor = before - 2 * peak + after
+			if divisor:
+				lag += 0.5 * (before - after) / divisor
+		return 60. / (lag * self.chunkSeconds)
+
+
 class AudioPulseInput(InputBase):
 	class AudioInputThread(Thread):
-		def __init__(self, parent, stopEvent, callBackFunction, configParams = {'chunk' : 1024, 'channels' : 1, 'rate' : 22500, 'recordSeconds' : 5}):
+		def __init__(self, parent, stopEvent, callBackFunction, configParams):
 			Thread.__init__(self)
-			configParams['format'] = pyaudio.paInt16
+			self.daemon = True
 			self.configParams = configParams
 			self.callBackFunction = callBackFunction
-			self.p=pyaudio.PyAudio()
 			self.stopEvent = stopEvent
-			self.stream = self.p.open(
-				format = configParams['format'],
-				channels = configParams['channels'], 
-				rate = configParams['rate'], 
-				input = True,
-				output = True
-			)
-			csum = []
-			spectlen = configParams['rate'] / configParams['chunk'] * configParams['recordSeconds']
-			self.makebands(configParams['chunk']/2)
-			self.bmax=0
+			self.dataReady = Event()
+			self.spaceReady = Event()
+			self.chunk = configParams['chunk']
+			self.source = audioSources[configParams['source']](configParams, self.receiveChunk)
+			self.channels = self.source.channels
+			self.rate = self.source.rate
+			self.ring = numpy.zeros((configParams['ringChunks'], self.chunk * self.channels), dtype=numpy.int16)
+			self.ringTimes = numpy.zeros(configParams['ringChunks'])
+			self.writeCount = 0
+			self.readCount = 0
+			self.overruns = 0
+			self.onsets = deque(maxlen = 1000) # (audio time at the end of the onset chunk, seconds from receiving the chunk to the beat pulse)
+			self.window = numpy.hanning(self.chunk).astype(numpy.float32)
+			self.bandEdges = makeBandEdges(self.chunk / 2 + 1, configParams['numBands'])
+			self.bandPeaks = numpy.ones(len(self.bandEdges))
+			self.onsetDetector = OnsetDetector(self.chunk / float(self.rate), configParams['onsetThresholdRatio'], configParams['minOnsetInterval'] / 1000.)
 			self.gain = 1.0
-			self.skip =8            # skip this many windows
 
 		def setgain(self,intgain):
 				self.gain = 2*intgain/100.0
 
-		def makebands(self,max):
-				"make a set of power-of-two bands. Max must be power of 2"
-				self.bands = []
-				self.scale = []
-				while max > 2:
-						self.bands.append(range(max/2, max))
-						self.scale.append(max)
-						max = max/2
-				self.bands[-1] = range(0,4)
-				self.bands.reverse()
-				self.scale.reverse()
+		def receiveChunk(self, inData):
+			samples = numpy.frombuffer(inData, dtype=numpy.int16)
+			if len(samples) == self.ring.shape[1]:
+				if not self.source.live:
+					while self.writeCount - self.readCount >= len(self.ring) and not self.stopEvent.isSet():
+						self.spaceReady.clear()
+						self.spaceReady.wait(0.1)
+				self.ring[self.writeCount % len(self.ring)] = samples
+				self.ringTimes[self.writeCount % len(self.ring)] = default_timer()
+				self.writeCount += 1
+				self.dataReady.set()
 
 		def run(self):
-			i = 0
+			self.source.start()
 			while not self.stopEvent.isSet():
-				i += 1
-				try:
-					data = self.stream.read(self.configParams['chunk'])
-				except Exception as e: # HO HUM!
-					data = False
-					time.sleep(0.01)
-				if i>2 and data:
-					i = 0
-					buff = numpy.array(struct.unpack_from('1024h',data))
-					bdata = range(len(self.bands))    
-					self.callBackFunction(bands=bdata, value = buff.std())
-					time.sleep(0.01)
+				if not self.dataReady.wait(0.1):
+					continue
+				self.dataReady.clear()
+				writeCount = self.writeCount
+				if writeCount - self.readCount > len(self.ring):
+					self.overruns += writeCount - self.readCount - len(self.ring)
+					self.readCount = writeCount - len(self.ring)
+				while self.readCount < writeCount:
+					self.analyseChunk(self.ring[self.readCount % len(self.ring)], self.ringTimes[self.readCount % len(self.ring)])
+					self.readCount += 1
+					self.spaceReady.set()
+
+		def analyseChunk(self, samples, receivedTime):
+			if self.channels > 1:
+				samples = samples.reshape(-1, self.channels).mean(axis=1)
+			samples = samples * self.gain
+			spectrum = numpy.fft.rfft(samples * self.window)
+			power = spectrum.real ** 2 + spectrum.imag ** 2
+			bandEnergies = numpy.add.reduceat(power, self.bandEdges)
+			self.bandPeaks = numpy.maximum(self.bandPeaks * self.configParams['bandPeakDecay'], bandEnergies)
+			onset = self.onsetDetector.process(numpy.abs(numpy.fft.rfft(samples))) # unwindowed, the window would hide onsets near the chunk edges
+			self.callBackFunction(bands = numpy.sqrt(bandEnergies / self.bandPeaks) * 100, value = samples.std(), onset = onset, tempo = self.onsetDetector.tempo)
+			if onset:
+				self.onsets.append(((self.readCount + 1) * self.chunk / float(self.rate), default_timer() - receivedTime))
+
+		def isFinished(self):
+			'''True once a file or generated source has run out and every chunk it made has been analysed'''
+			return not self.source.live and self.source.finished.isSet() and self.readCount == self.writeCount
 
 		def stop(self):
-			sys.stdout.flush()
 			self.stopEvent.set()
-			self.stream.stop_stream()
-			self.stream.close()
-			self.p.terminate()
+			self.source.stop()
 
-	def __init__(self, *args):
-		InputBase.__init__(self, *args)
-		self.audioThread = AudioPulseInput.AudioInputThread(self, Event(), self.handleAudioUpdate)
+	def __init__(self, params, *args):
+		if params['source'] == 'mic' and not pyaudio:
+			raise ValueError('the mic audio source needs pyaudio, which is not installed')
+		if not params['source'] in audioSources:
+			raise ValueError('unknown audio source %s, use one of %s' %(params['source'], ', '.join(sorted(audioSources))))
+		params['outParams'] = params['outParams'][:3] # pulse, beat and tempo, band outParams are rebuilt from numBands
+		for bandIndex in range(len(makeBandEdges(params['chunk'] / 2 + 1, params['numBands']))):
+			params['outParams'].append({'type' : 'value', 'description' : 'Band %s' %(bandIndex), 'min' : 0, 'max' : 100})
+		InputBase.__init__(self, params, *args)
+		self.audioThread = AudioPulseInput.AudioInputThread(self, Event(), self.handleAudioUpdate, self.configParams)
 		self.audioThread.start()
-		
+
 	def stop(self):
 		self.audioThread.stop()
 		InputBase.stop(self)
 
-	def handleAudioUpdate(self, bands, value):
+	def handleAudioUpdate(self, bands, value, onset, tempo):
+		for bandIndex in range(len(bands)):
+			self.outParams[bandIndex + 3].setValue(bands[bandIndex])
+		self.outParams[2].setValue(tempo)
+		if onset:
+			self.outParams[1].setValue(True)
 		if (value > self.inParams[0].getValue()):
 			self.outParams[0].setValue(True)
-	
 
+	def getCurrentStateData(self):
+		data = InputBase.getCurrentStateData(self)
+		data['audioStats'] = {'chunks' : self.audioThread.readCount, 'overruns' : self.audioThread.overruns, 'onsets' : len(self.audioThread.onsets)}
+		return data
+
+	def getStateVersion(self):
+		return (self.getVersion(), self.audioThread.readCount)
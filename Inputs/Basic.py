@@ -2,8 +2,9 @@
 keyboard bindings, timers, audio pulse thingeys, etc. There will be several broad types such as pulse and value, and any input of the same type 
 will be interchangeable
 ''' 
-from ProgramModules.Timers import Timer
+from ProgramModules.Timers import Timer, monotonicTime
 from ProgramModules import utils
+import ProgramModules.sharedObjects as app
 from InputBase import InputBase
 import json
 import time
@@ -15,6 +16,7 @@ inputTypes = {
 		'shortDescription' : 'Timer Pulse',
 		'inParams' : [{'type' : 'value', 'subType' : 'int', 'description' : 'Interval(ms)', 'max' : 2000, 'min' : 50}],
 		'outParams' : [{'type' : 'pulse', 'sendMessageOnChange' : True}],
+		'catchUpPolicy' : 'skip',
 		'hasOwnClass' : True
 	},
 	'onOff pulse' : {
@@ -91,11 +93,16 @@ inputTypes = {
 	}
 }
 
+try:
+	import numpy
+except:
+	inputTypes['randomPulse multi']['unavailable'] = True
+
 
 class TimerPulseInput(InputBase):
 	def __init__(self, *args):
 		InputBase.__init__(self, *args)
-		self.timer = Timer(True, self.inParams[0].getValue(), getattr(self, 'sendPulse'))
+		self.timer = Timer(True, self.inParams[0].getValue(), getattr(self, 'sendPulse'), catchUpPolicy = self.configParams['catchUpPolicy'])
 
 	def stop(self):
 		self.timer.stop()
@@ -115,6 +122,14 @@ class TimerPulseInput(InputBase):
 	def updateOutputValues(self):
 		pass
 
+	def getCurrentStateData(self):
+		data = InputBase.getCurrentStateData(self)
+		data['timer'] = self.timer.getCurrentStateData()
+		return data
+
+	def getStateVersion(self):
+		return (self.getVersion(), self.timer.fireCount, self.timer.skipCount)
+
 
 class BasicMultiInput(InputBase):
 	def __init__(self, configParams, *args):
@@ -159,14 +174,60 @@ class RandomPulseInput(InputBase):
 		self.outParams[index].setValue(False)
 		
 class RandomPulseMultiInput(RandomPulseInput):
+	'''Draws every channel's fire decision and off time as one numpy vector per check, and publishes all the
+	channels that changed as one list on the output<id>_changes channel instead of a message per channel'''
 	def __init__(self, params, *args):
-		params = utils.multiExtendSettings(inputTypes['random pulse'], inputTypes['randomPulse multi'], params)
+		params = utils.multiExtendSettings(inputTypes['random pulse'], inputTypes['randomPulse multi'], params, cacheKey = 'randomPulse multi')
 		self.numPulses = params['number']
 		for inputIndex in range(len(params['inParams'])):
 			params['inParams'][inputIndex]['relevance'] = [i for i in range(self.numPulses)]
-		params['outParams'] = [{'type' : 'toggle', 'sendMessageOnChange' : True, 'description' : 'channel%s' %(i)} for i in range(self.numPulses)]
+		params['outParams'] = [{'type' : 'toggle', 'description' : 'channel%s' %(i)} for i in range(self.numPulses)]
 		InputBase.__init__(self, params, *args)
+		self.batchChannelId = 'output%s_changes' %(self.instanceId)
+		self.batchChannel = app.messenger.getChannel(self.batchChannelId)
+		self.batchChannel.setQueuing(False)
+		self.random = numpy.random.RandomState()
+		self.onStates = numpy.zeros(self.numPulses, dtype=bool)
+		self.offDeadlines = numpy.zeros(self.numPulses)
+		self.changedIndices = []
 		self.checkTimer = Timer(True, 200, self.doCheck)
-		self.onStates = [False for i in range(self.numPulses)]
-		self.offTimers = [Timer(False, self.inParams[1].getValue(), self.turnOff, (i,)) for i in range(self.numPulses)]
-	
+		self.offTimer = Timer(False, 200, self.doOffCheck)
+
+	def stop(self):
+		self.checkTimer.stop()
+		self.offTimer.stop()
+		app.messenger.releaseChannel(self.batchChannelId)
+		InputBase.stop(self)
+
+	def doCheck(self):
+		now = monotonicTime()
+		rarity = int(self.inParams[0].getValue())
+		minTime, maxTime = sorted([int(self.inParams[1].getValue()), int(self.inParams[2].getValue())])
+		fired = self.random.randint(0, rarity + 1, self.numPulses) < 2
+		offTimes = self.random.randint(minTime, maxTime + 1, self.numPulses) / 1000.
+		self.offDeadlines[fired] = now + offTimes[fired]
+		turnedOn = fired & ~self.onStates
+		self.onStates |= fired
+		self.applyChanges(turnedOn | self.takeExpired(now))
+
+	def doOffCheck(self):
+		self.applyChanges(self.takeExpired(monotonicTime()))
+
+	def takeExpired(self, now):
+		expired = self.onStates & (self.offDeadlines <= now)
+		self.onStates &= ~expired
+		return expired
+
+	def applyChanges(self, changed):
+		if self.onStates.any():
+			self.offTimer.changeInterval(max((self.offDeadlines[self.onStates].min() - monotonicTime()) * 1000., 0))
+			self.offTimer.refresh()
+		changedIndices = numpy.flatnonzero(changed).tolist()
+		if changedIndices:
+			for index in changedIndices:
+				self.outParams[index].setValue(self.onStates[index])
+			self.changedIndices = changedIndices
+			self.batchChannel.publish(changedIndices)
+
+	def getChangedIndices(self):
+		return self.changedIndices
@@ -5,6 +5,10 @@ will be interchangeable
 from ProgramModules import utils
 import IoParams
 class InputBase():
+	pushesOutputValues = True # outParams are kept current by setValue, so readers can skip updateOutputValues. Set False in subclasses that compute outputs on read.
+	# version goes up every time one of the input's params changes value, so consumers can cache anything
+	# they compute from the input and skip the work while the version hasn't moved.
+
 	def __init__(self, configParams, instanceId):
 		self.configParams = utils.multiExtendSettings({'inParams' : [], 'outParams' : [], 'direct' : False}, configParams)
 		possibleInParamKeys = ['min', 'max', 'default', 'description', 'sendMessageOnChange', 'choices']
@@ -18,6 +22,9 @@ class InputBase():
 		self.outParams = []
 		self.inParams = []
 		self.instanceId = instanceId
+		self.version = 0
+		self.stateDataCache = False
+		self.stateDataVersion = -1
 		if self.configParams['direct']:
 			for paramIndex in range(len(self.configParams['inParams'])):
 				self.outParams.append(self.makeIoParam(self.configParams['inParams'][paramIndex], paramIndex))
@@ -35,13 +42,24 @@ class InputBase():
 
 
 	def getValue(self, outputIndex = 0):
-		self.updateOutputValues()
+		if not self.pushesOutputValues:
+			self.updateOutputValues()
 		return self.outParams[outputIndex].getValue()
 
+	def getVersion(self):
+		if not self.pushesOutputValues:
+			self.updateOutputValues()
+		return self.version
+
+	def getStateVersion(self): # changes whenever getCurrentStateData would. Inputs that add live stats to their state data add those too
+		return self.getVersion()
+
 		
 	def makeIoParam(self, params, paramIndex=0):
 		paramClass = getattr(IoParams, utils.makeCamelCase([params['type'], 'param'], True))
-		return paramClass(params, self.instanceId, paramIndex)
+		ioParam = paramClass(params, self.instanceId, paramIndex)
+		ioParam.owner = self
+		return ioParam
 
 	def getId(self):
 		return self.instanceId
@@ -52,16 +70,19 @@ class InputBase():
 
 
 	def getCurrentStateData(self):
-		self.updateOutputValues()
-		data = self.configParams.copy()
-		data['inParams'] = []
-		data['outParams'] = []
-		for input in self.inParams:
-			data['inParams'].append(input.getCurrentStateData())
-		for output in self.outParams:
-			data['outParams'].append(output.getCurrentStateData())
-		data['instanceId'] = self.instanceId
-		return data
+		version = self.getVersion()
+		if not self.stateDataVersion == version:
+			data = self.configParams.copy()
+			data['inParams'] = []
+			data['outParams'] = []
+			for input in self.inParams:
+				data['inParams'].append(input.getCurrentStateData())
+			for output in self.outParams:
+				data['outParams'].append(output.getCurrentStateData())
+			data['instanceId'] = self.instanceId
+			self.stateDataCache = data
+			self.stateDataVersion = version
+		return self.stateDataCache.copy()
 
 
 	def stop(self):
@@ -1,24 +1,94 @@
-'''These are the rudimentry inputs and outputs of all the higher level inputs used by the program. 
-All settable parameters of inputs and all output channels to patterns are instances of these'''
+'''These are the rudimentry inputs and outputs of all the higher level inputs used by the program.
+All settable parameters of inputs and all output channels to patterns are instances of these
 
-from ProgramModules import utils
+Patterns on big grids make hundreds of these, so they're kept small. Params are __slots__ classes, the defaults
+for each class are one shared dict that is never written to, and each instance's params only store the settings
+that differ from those defaults. Settings read on every setValue are also copied into slots when the param is made.
+
+ValueParams can have a coalesceWindow(ms). The first change publishes right away and opens the window; changes
+inside the window only overwrite the value, and when the window closes the latest value is published once.
+Their messages are (value, coalescedCount), the number of changes folded into that message, which is also kept
+in lastCoalescedCount.'''
+
+from threading import Lock
 from ProgramModules.Timers import Timer
 import ProgramModules.sharedObjects as app
 
-class IoParamBase():
+class ParamSettings(object):
+	'''Dict-like view of a param's settings. Reads fall through to the shared class defaults, writes only go to overrides'''
+	__slots__ = ('defaults', 'overrides')
+
+	def __init__(self, defaults, settings):
+		self.defaults = defaults
+		self.overrides = {}
+		for key in settings:
+			value = settings[key]
+			if not (key in defaults and type(defaults[key]) is type(value) and defaults[key] == value):
+				self.overrides[key] = value
+
+	def __getitem__(self, key):
+		try:
+			return self.overrides[key]
+		except KeyError:
+			return self.defaults[key]
+
+	def __setitem__(self, key, value):
+		self.overrides[key] = value
+
+	def __contains__(self, key):
+		return key in self.overrides or key in self.defaults
+
+	def get(self, key, default = None):
+		return self[key] if key in self else default
+
+	def keys(self):
+		return list(set(self.defaults.keys()) | set(self.overrides.keys()))
+
+	def copy(self):
+		data = dict(self.defaults)
+		data.update(self.overrides)
+		return data
+
+
+class IoParamBase(object):
+	__slots__ = ('params', 'parentId', 'indexId', 'owner', 'version', 'value', 'outputChannel', 'sendMessageOnChange')
+	defaultParams = {}
+
 	def __init__(self, params, parentId = 0, indexId = 0):
-		self.params = utils.extendSettings(self.defaultParams, params)
+		self.params = ParamSettings(self.defaultParams, params)
 		self.parentId = parentId
 		self.indexId = indexId
+		self.owner = False
+		self.version = 0
+		self.sendMessageOnChange = self.params['sendMessageOnChange']
+		self.cacheSettings()
 		self.value = self.constrain(self.params['default'])
-		if self.params['sendMessageOnChange']:
-			app.messenger.setQueuing("output%s_%s" %(self.parentId, self.indexId), False)
+		self.outputChannel = False
+
+	def cacheSettings(self):
+		pass
+
 	def getValue(self):
 		return self.value
-	
-	def stop(self):
-		pass
-		
+
+	def markChanged(self):
+		self.version += 1
+		if self.owner:
+			self.owner.version += 1
+
+	def getOutputChannelId(self):
+		return "output%s_%s" %(self.parentId, self.indexId)
+
+	def getOutputChannel(self): # made on the first publish, so params that never publish don't hold a channel
+		if not self.outputChannel:
+			self.outputChannel = app.messenger.getChannel(self.getOutputChannelId())
+			self.outputChannel.setQueuing(False)
+		return self.outputChannel
+
+	def stop(self): # also drops the channel if something bound to it made it before this param published
+		app.messenger.releaseChannel(self.getOutputChannelId())
+		self.outputChannel = False
+
 	def getCurrentStateData(self):
 		data = self.params.copy()
 		data['currentValue'] = self.value
@@ -26,9 +96,20 @@ class IoParamBase():
 
 
 class ValueParam(IoParamBase):
+	__slots__ = ('coalesceWindow', 'coalesceLock', 'coalesceTimer', 'coalesceWindowOpen', 'pendingChanges', 'lastCoalescedCount', 'totalCoalescedCount', 'isInt', 'minValue', 'maxValue')
+	defaultParams = {'description' : '', 'subType' : '', 'default' : 0, 'sendMessageOnChange' : False,  'min' : 0, 'max' : 100, 'coalesceWindow' : 0}
+
 	def __init__(self, *args):
-		self.defaultParams = {'description' : '', 'subType' : '', 'default' : 0, 'sendMessageOnChange' : False,  'min' : 0, 'max' : 100}
 		IoParamBase.__init__(self, *args)
+		self.coalesceWindow = self.params['coalesceWindow']
+		self.coalesceLock = Lock() if self.coalesceWindow else False
+		self.coalesceTimer = False
+		self.coalesceWindowOpen = False
+		self.pendingChanges = 0
+		self.lastCoalescedCount = 0
+		self.totalCoalescedCount = 0
+
+	def cacheSettings(self):
 		if not self.params['min'] == False:
 			try:
 				int(self.params['min'])
@@ -39,43 +120,90 @@ class ValueParam(IoParamBase):
 				int(self.params['max'])
 			except:
 				self.params['max'] = 100
-		self.value = self.constrain(self.params['default'])
-		
+		self.isInt = self.params['subType'] == 'int'
+		self.minValue = self.params['min']
+		self.maxValue = self.params['max']
+
 	def setValue(self, newValue):
 		newValue = self.constrain(newValue)
 		if (not self.value == newValue):
 			self.value = newValue
-			if self.params['sendMessageOnChange']:
-				app.messenger.putMessage("output%s_%s" %(self.parentId, self.indexId), self.value)
+			self.markChanged()
+			if self.sendMessageOnChange:
+				if self.coalesceWindow:
+					self.publishCoalesced()
+				else:
+					self.getOutputChannel().publish(self.value)
+
+	def publishCoalesced(self):
+		with self.coalesceLock:
+			if self.coalesceWindowOpen:
+				self.pendingChanges += 1
+				return
+			self.coalesceWindowOpen = True
+			self.lastCoalescedCount = 1
+			self.openCoalesceWindow()
+		self.getOutputChannel().publish((self.value, 1))
+
+	def openCoalesceWindow(self):
+		if self.coalesceTimer:
+			self.coalesceTimer.refresh()
+		else:
+			self.coalesceTimer = Timer(False, self.coalesceWindow, self.closeCoalesceWindow)
+
+	def closeCoalesceWindow(self):
+		with self.coalesceLock:
+			if not self.pendingChanges:
+				self.coalesceWindowOpen = False
+				return
+			coalescedCount = self.lastCoalescedCount = self.pendingChanges
+			self.totalCoalescedCount += coalescedCount - 1
+			self.pendingChanges = 0
+			self.openCoalesceWindow()
+		self.getOutputChannel().publish((self.value, coalescedCount))
+
+	def stop(self):
+		if self.coalesceTimer:
+			self.coalesceTimer.stop()
+		IoParamBase.stop(self)
+
+	def getCurrentStateData(self):
+		data = IoParamBase.getCurrentStateData(self)
+		if self.coalesceWindow:
+			data['coalescedCount'] = self.totalCoalescedCount
+		return data
 
 	def constrain(self, value):
 		try:
-			if self.params['subType'] == 'int':
+			if self.isInt:
 				value = int(value)
 			else:
 				value = float(value)
 		except:
 			value = 0
-		if not (self.params['min'] == False):
-			if value < self.params['min']:
-				value = self.params['min']
-		if not (self.params['max'] == False):
-			if value > self.params['max']:
-				value = self.params['max']
+		if not (self.minValue == False):
+			if value < self.minValue:
+				value = self.minValue
+		if not (self.maxValue == False):
+			if value > self.maxValue:
+				value = self.maxValue
 		return value
 
 
 class PulseParam(IoParamBase):
+	__slots__ = ('timer',)
+	defaultParams = {'description' : '', 'subType' : '', 'default' : False, 'sendMessageOnChange' : False, 'toggleTimeOut' : 30}
+
 	def __init__(self, *args):
-		self.defaultParams = {'description' : '', 'subType' : '', 'default' : False, 'sendMessageOnChange' : False, 'toggleTimeOut' : 30}
 		IoParamBase.__init__(self, *args)
 		self.timer = False
 
 	def setValue(self, newValue):
 		newValue = self.constrain(newValue)
 		self.value = newValue
-		if self.params['sendMessageOnChange']:
-			app.messenger.putMessage("output%s_%s" %(self.parentId, self.indexId), self.value)
+		self.markChanged()
+		if self.sendMessageOnChange:
+			self.getOutputChannel().publish(self.value)
 		if newValue:
 			if self.timer:
 				self.timer.refresh()
@@ -88,37 +216,38 @@ class PulseParam(IoParamBase):
 	def stop(self):
 		if self.timer:
 			self.timer.stop()
+		IoParamBase.stop(self)
 
 
 class ToggleParam(IoParamBase):
-	def __init__(self, *args):
-		self.defaultParams = {'description' : '', 'subType' : '', 'default' : False, 'sendMessageOnChange' : False}
-		IoParamBase.__init__(self, *args)
-		
+	__slots__ = ()
+	defaultParams = {'description' : '', 'subType' : '', 'default' : False, 'sendMessageOnChange' : False}
+
 	def setValue(self, newValue):
 		newValue = self.constrain(newValue)
 		if (not self.value == newValue):
 			self.value = newValue
-			if self.params['sendMessageOnChange']:
-				app.messenger.putMessage("output%s_%s" %(self.parentId, self.indexId), self.value)
-		
+			self.markChanged()
+			if self.sendMessageOnChange:
+				self.getOutputChannel().publish(self.value)
+
 	def constrain(self, value):
 		return bool(value)
-		
-		
+
+
 class TextParam(IoParamBase):
-	def __init__(self, *args):
-		self.defaultParams = {'description' : '', 'subType' : '', 'default' : '', 'sendMessageOnChange' : False}
-		IoParamBase.__init__(self, *args)
-		
+	__slots__ = ()
+	defaultParams = {'description' : '', 'subType' : '', 'default' : '', 'sendMessageOnChange' : False}
+
 	def getValue(self):
 		return self.value
 	def setValue(self, newValue):
 		newValue = self.constrain(newValue)
 		if (not self.value == newValue):
 			self.value = newValue
-			if self.params['sendMessageOnChange']:
-				app.messenger.putMessage("output%s_%s" %(self.parentId, self.indexId), self.value)
+			self.markChanged()
+			if self.sendMessageOnChange:
+				self.getOutputChannel().publish(self.value)
 
 	def constrain(self, value):
 		if self.params['subType'] == 'choice' and not value in self.params['choices'].keys():
@@ -1,38 +1,226 @@
+''' OSC server input. Listens on a non-blocking UDP socket and decodes OSC packets itself, so pyOSC isn't
+needed. Every packet waiting on the socket is read and dispatched in one pass.
+
+Configured addresses are compiled into a trie with one level per address part. Incoming addresses can be OSC
+address patterns (?, *, [a-z], [!abc], {foo,bar}), so one message can reach many outputs. Literal parts are
+dict lookups, pattern parts are matched against the children at that level only. The resolved targets for
+each incoming address are memoised, so repeated addresses cost one dict lookup.
+'''
 from InputBase import InputBase
 from threading import Thread, Event
-from ProgramModules import utils
+import re
+import select
+import socket
+import struct
+import time
 
 inputTypes = {
 	'osc multi' : {
-		'longDescription' : 'OpenSoundControl server', 
-		'shortDescription' : 'OSC server', 
-		'host' : '127.0.0.2', 
-		'port' : 8000, 
-		'setupParamsNeeded' : [['text', 'Host', 'host'], ['int', 'Port', 'port'], ['text', 'Button addresses(separated by space)', 'pulseAddressString'], ['text', 'Toggle addresses(separated by space)', 'toggleAddressString'], ['text', 'Value addresses(separated by space)', 'valueAddressString']],
+		'longDescription' : 'OpenSoundControl server',
+		'shortDescription' : 'OSC server',
+		'host' : '127.0.0.2',
+		'port' : 8000,
+		'coalesceWindow' : 20, # ms, value addresses publish at most once per window with the latest value
+		'setupParamsNeeded' : [['text', 'Host', 'host'], ['int', 'Port', 'port'], ['int', 'Value coalescing window(ms)', 'coalesceWindow'], ['text', 'Button addresses(separated by space)', 'pulseAddressString'], ['text', 'Toggle addresses(separated by space)', 'toggleAddressString'], ['text', 'Value addresses(separated by space)', 'valueAddressString']],
 		'callbackAddresses' : {'pulse' : ['/1/button1', '/1/button2', '/1/button3'], 'toggle' : [], 'value' : ['/1/value1', '/1/value2', '/1/value3']},
 		'hasOwnClass' : True
 	}
 }
 
-try:
-	from OSC import OSCServer,OSCClient, OSCMessage
-except:
-	inputTypes['osc multi']['unavailable'] = True
+
+class OscParseError(Exception):
+	pass
+
+def readOscString(data, offset):
+	end = data.find('\0', offset)
+	if end < 0:
+		raise OscParseError('unterminated string at %s' %(offset))
+	return data[offset:end], (end + 4) & ~3
+
+def readOscBlob(data, offset):
+	size = struct.unpack_from('>i', data, offset)[0]
+	offset += 4
+	if size < 0 or offset + size > len(data):
+		raise OscParseError('bad blob size %s at %s' %(size, offset))
+	return data[offset:offset + size], (offset + size + 3) & ~3
+
+oscArgReaders = {
+	'i' : lambda data, offset: (struct.unpack_from('>i', data, offset)[0], offset + 4),
+	'f' : lambda data, offset: (struct.unpack_from('>f', data, offset)[0], offset + 4),
+	'h' : lambda data, offset: (struct.unpack_from('>q', data, offset)[0], offset + 8),
+	'd' : lambda data, offset: (struct.unpack_from('>d', data, offset)[0], offset + 8),
+	't' : lambda data, offset: (struct.unpack_from('>Q', data, offset)[0], offset + 8),
+	'c' : lambda data, offset: (chr(struct.unpack_from('>I', data, offset)[0] & 0xff), offset + 4),
+	's' : readOscString,
+	'S' : readOscString,
+	'b' : readOscBlob,
+	'T' : lambda data, offset: (True, offset),
+	'F' : lambda data, offset: (False, offset),
+	'N' : lambda data, offset: (None, offset),
+	'I' : lambda data, offset: (float('inf'), offset),
+}
+
+def decodeOscPacket(data, messages = None):
+	'''Returns a list of (address, typeTags, args) for the message or every message nested in the bundle'''
+	if messages is None:
+		messages = []
+	try:
+		if data.startswith('#bundle\0'):
+			offset = 16 # skip the time tag, messages are handled as soon as they arrive
+			while offset < len(data):
+				size = struct.unpack_from('>i', data, offset)[0]
+				offset += 4
+				if size <= 0 or offset + size > len(data):
+					raise OscParseError('bad bundle element size %s' %(size))
+				decodeOscPacket(data[offset:offset + size], messages)
+				offset += size
+			return messages
+		address, offset = readOscString(data, 0)
+		if not address.startswith('/'):
+			raise OscParseError('bad address %r' %(address))
+		typeTags = ''
+		args = []
+		if offset < len(data):
+			typeTags, offset = readOscString(data, offset)
+			if not typeTags.startswith(','):
+				raise OscParseError('bad type tags %r' %(typeTags))
+			typeTags = typeTags[1:]
+			for typeTag in typeTags:
+				if not typeTag in oscArgReaders:
+					raise OscParseError('unsupported type tag %r' %(typeTag))
+				arg, offset = oscArgReaders[typeTag](data, offset)
+				args.append(arg)
+		messages.append((address, typeTags, args))
+		return messages
+	except struct.error as e:
+		raise OscParseError(str(e))
+
+def encodeOscString(value):
+	value = str(value) + '\0'
+	return value + '\0' * (-len(value) % 4)
+
+def encodeOscMessage(address, args = []):
+	typeTags = ','
+	encodedArgs = ''
+	for arg in args:
+		if isinstance(arg, bool):
+			typeTags += 'T' if arg else 'F'
+		elif isinstance(arg, int):
+			typeTags += 'i'
+			encodedArgs += struct.pack('>i', arg)
+		elif isinstance(arg, float):
+			typeTags += 'f'
+			encodedArgs += struct.pack('>f', arg)
+		else:
+			typeTags += 's'
+			encodedArgs += encodeOscString(arg)
+	return encodeOscString(address) + encodeOscString(typeTags) + encodedArgs
+
+def encodeOscBundle(elements, timeTag = 1):
+	data = encodeOscString('#bundle') + struct.pack('>Q', timeTag)
+	for element in elements:
+		data += struct.pack('>i', len(element)) + element
+	return data
+
+
+def compileOscPartPattern(part):
+	'''Returns a compiled regex for one part of an OSC address pattern, or False if the part is a literal'''
+	if not re.search(r'[?*\[\]{}]', part):
+		return False
+	regex = ''
+	i = 0
+	while i < len(part):
+		char = part[i]
+		if char == '*':
+			regex += '.*'
+		elif char == '?':
+			regex += '.'
+		elif char == '[':
+			end = part.find(']', i)
+			if end < 0:
+				raise OscParseError('unterminated [ in %r' %(part))
+			charSet = part[i + 1:end]
+			negate = charSet.startswith('!')
+			if negate:
+				charSet = charSet[1:]
+			regex += '[' + ('^' if negate else '') + ''.join(['\\' + c if c in '\\^]' else c for c in charSet]) + ']'
+			i = end
+		elif char == '{':
+			end = part.find('}', i)
+			if end < 0:
+				raise OscParseError('unterminated { in %r' %(part))
+			regex += '(?:' + '|'.join([re.escape(choice) for choice in part[i + 1:end].split(',')]) + ')'
+			i = end
+		else:
+			regex += re.escape(char)
+		i += 1
+	return re.compile(regex + '$')
+
+
+class OscAddressTrie():
+	def __init__(self, maxMemoisedAddresses = 4096):
+		self.root = {'children' : {}, 'targets' : []}
+		self.memo = {}
+		self.maxMemoisedAddresses = maxMemoisedAddresses
+
+	def add(self, address, target):
+		node = self.root
+		for part in address.split('/')[1:]:
+			node = node['children'].setdefault(part, {'children' : {}, 'targets' : []})
+		node['targets'].append(target)
+		self.memo = {}
+
+	def match(self, address):
+		try:
+			return self.memo[address]
+		except KeyError:
+			pass
+		nodes = [self.root]
+		for part in address.split('/')[1:]:
+			pattern = compileOscPartPattern(part)
+			nextNodes = []
+			for node in nodes:
+				if pattern:
+					nextNodes += [node['children'][childPart] for childPart in node['children'] if pattern.match(childPart)]
+				elif part in node['children']:
+					nextNodes.append(node['children'][part])
+			nodes = nextNodes
+			if not nodes:
+				break
+		targets = []
+		for node in nodes:
+			targets += node['targets']
+		if len(self.memo) >= self.maxMemoisedAddresses:
+			self.memo = {}
+		self.memo[address] = targets
+		return targets
 
 
 class OscMultiInput(InputBase):
 	class OscServerThread(Thread):
-		def __init__(self, host, stopEvent):
+		def __init__(self, host, stopEvent, handlePacket, maxPacketsPerPass = 64):
 			Thread.__init__(self)
-			self.server = OSCServer(host)
+			self.daemon = True
+			self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20) # room for fader bursts between passes
+			self.socket.bind(host)
+			self.socket.setblocking(0)
 			self.stopEvent = stopEvent
-		def setCallBacks(self, callBacks):
-			for callBack in callBacks:
-				self.server.addMsgHandler(callBack[0], callBack[1])
+			self.handlePacket = handlePacket
+			self.maxPacketsPerPass = maxPacketsPerPass
 		def run(self):
 			while not self.stopEvent.is_set():
-				self.server.handle_request()
-			self.server.close()
+				readable = select.select([self.socket], [], [], 0.1)[0]
+				packetCount = 0
+				while readable and packetCount < self.maxPacketsPerPass:
+					try:
+						data, source = self.socket.recvfrom(65535)
+					except socket.error:
+						break
+					packetCount += 1
+					self.handlePacket(data, source)
+			self.socket.close()
 
 	def __init__(self, params, *args):
 		self.outputTypes = ['pulse', 'toggle', 'value']
@@ -50,56 +238,74 @@ class OscMultiInput(InputBase):
 			params['callbackAddresses'] = callbackAddresses
 		params['outParams'] = []
 		for outputType in self.outputTypes:
-			for address in params['callbackAddresses'][outputType]:
+			for address in params['callbackAddresses'].get(outputType, []):
 				params['outParams'].append({'type' : outputType, 'description' : outputType[0].upper() + outputType[1:] + ' ' + address, 'sendMessageOnChange' : True})
-			
+				if outputType == 'value':
+					params['outParams'][-1]['coalesceWindow'] = int(params.get('coalesceWindow', 0))
+
 		InputBase.__init__(self, params, *args)
-		self.callbackLinkList = []
+		self.stats = {'packets' : 0, 'messages' : 0, 'parseErrors' : 0, 'unknownAddresses' : 0, 'packetsPerSecond' : 0}
+		self.rateWindowStart = time.time()
+		self.rateWindowPackets = 0
+		self.buildAddressTable()
 		self.stopEvent = Event()
-		self.server = OscMultiInput.OscServerThread((self.configParams['host'], self.configParams['port']), self.stopEvent)
-		self.buildCallbackLinkList()
-		self.server.setCallBacks(self.callbackLinkList)
+		self.server = OscMultiInput.OscServerThread((self.configParams['host'], self.configParams['port']), self.stopEvent, self.handlePacket)
 		self.server.start()
 		self.persistant = True
 
-
-	def buildCallbackLinkList(self):
+	def buildAddressTable(self): # address trie of (outParam index, callback) targets, outParams are in the same order as built above
+		self.addressTrie = OscAddressTrie()
+		outParamIndex = 0
 		for callbackType in self.outputTypes:
-			if callbackType in self.configParams['callbackAddresses'].keys():
-				function = getattr(self, utils.makeCamelCase(['do', callbackType, 'callback']))
-				for callbackAddress in self.configParams['callbackAddresses'][callbackType]:
-					self.callbackLinkList.append([callbackAddress, function])
+			function = getattr(self, 'do%sCallback' %(callbackType[0].upper() + callbackType[1:]))
+			for callbackAddress in self.configParams['callbackAddresses'].get(callbackType, []):
+				self.addressTrie.add(callbackAddress, (outParamIndex, function))
+				outParamIndex += 1
+
+	def handlePacket(self, data, source):
+		self.stats['packets'] += 1
+		self.rateWindowPackets += 1
+		now = time.time()
+		if now - self.rateWindowStart >= 1:
+			self.stats['packetsPerSecond'] = self.rateWindowPackets / (now - self.rateWindowStart)
+			self.rateWindowStart = now
+			self.rateWindowPackets = 0
+		try:
+			messages = decodeOscPacket(data)
+		except OscParseError:
+			self.stats['parseErrors'] += 1
+			return
+		for address, typeTags, args in messages:
+			try:
+				targets = self.addressTrie.match(address)
+			except OscParseError:
+				self.stats['parseErrors'] += 1
+				continue
+			if not targets:
+				self.stats['unknownAddresses'] += 1
+				continue
+			self.stats['messages'] += 1
+			if args:
+				for outputIndex, function in targets:
+					function(outputIndex, args)
 
 	def stop(self):
 		self.stopEvent.set()
 		InputBase.stop(self)
 
-	def doPulseCallback(self, path, tags, args, source):
-		outputIndex = self.getOutputIndexFromAddress(path, 'pulse')
-		self.outParams[outputIndex].setValue(args[0] in ['1', 1, 'true', 'True'])
+	def doPulseCallback(self, outputIndex, args):
+		self.outParams[outputIndex].setValue(args[0] in ['1', 1, 'true', 'True', True])
 
-	def doToggleCallback(self, path, tags, args, source):
-		outputIndex = self.getOutputIndexFromAddress(path, 'toggle')
+	def doToggleCallback(self, outputIndex, args):
 		self.outParams[outputIndex].setValue(args[0])
 
-	def doValueCallback(self, path, tags, args, source):
-		outputIndex = self.getOutputIndexFromAddress(path, 'value')
+	def doValueCallback(self, outputIndex, args):
 		self.outParams[outputIndex].setValue(args[0])
 
+	def getCurrentStateData(self):
+		data = InputBase.getCurrentStateData(self)
+		data['oscStats'] = self.stats.copy()
+		return data
 
-	def getOutputIndexFromAddress(self, path, callbackType):
-		if path[:-2].isdigit():
-			addrNum = int(path[:-2])
-		elif path[:-1].isdigit():
-			addrNum = int(path[:-1])
-		else:
-			return False
-		index = addrNum-1
-		done = False
-		for outputType in outputTypes:
-			if callbackType == outputType:
-				done = True
-			if not done:
-				index += len(self.configParams[outputType])
-		return index
-
+	def getStateVersion(self):
+		return (self.getVersion(), self.stats['packets'])
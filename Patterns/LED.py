@@ -138,6 +138,11 @@ class HeartBeat(PatternBase):
 	# (the further away, the darker).
 	DISTANCE_DIFF = 0.05
 
+	# Input channels that feed the precomputed values. Their version is
+	# checked on every step to skip recomputation when nothing changed.
+	PARAMETER_CHANNELS = ['heart_pos', 'max_brightness', 'red', 'green',
+			      'blue']
+
 	def __init__(self, *args):
 		# Passed in via SculptureModuleBase.addPattern().
 		grid_size = args[0]
@@ -193,6 +198,7 @@ class HeartBeat(PatternBase):
 				'type' : 'pulse',
 				'subType' : 'timer',
 				'bindToFunction' : 'triggerStep',
+				'shared' : True, # stacked HeartBeats run off one timer until one of them changes or refreshes it
 				'min' : 1 ,
 				'max' : 100,
 				'default' : 1,
@@ -265,6 +271,9 @@ class HeartBeat(PatternBase):
 		self._led_values_last_index = len(self._led_values) - 1
 		# Index of the currently used heart brightness value.
 		self._led_values_index = 0
+		# Version of the parameter inputs the local values were last
+		# updated from.
+		self._input_version = self.inputs.getVersion(self.PARAMETER_CHANNELS)
 
 	def _compute_heart_values(self):
 		"""Precompute heart brightness values.
@@ -385,24 +394,33 @@ class HeartBeat(PatternBase):
 		"""
 		if self.inputs.triggerStep and self.sequenceTriggered:
 			logging.debug('HeartBeat.triggerStep() called.')
-			# HACK: As mentioned above, we assume a single row and
-			# only update the column of the heart position
-			if self._heart_col != self.inputs.heart_pos:
-				self._update_heart_position(
-					self._heart_row, self.inputs.heart_pos)
-			# Update brightness based on input values.
-			if self._max_brightness != self.inputs.max_brightness:
-				self._max_brightness = self.inputs.max_brightness
-				self._led_values = self._compute_heart_values()
-			if ((self._red != self.inputs.red) or
-			    (self._green != self.inputs.green) or
-			    (self._blue != self.inputs.blue)):
-				self._update_color((self.inputs.red,
-						    self.inputs.green,
-						    self.inputs.blue))
+			# Only look at the parameter inputs when one of them has
+			# changed since the last step.
+			input_version = self.inputs.getVersion(self.PARAMETER_CHANNELS)
+			if input_version != self._input_version:
+				self._input_version = input_version
+				self._update_from_inputs()
 			self._update_leds()
 			self.requestUpdate()
 
+	def _update_from_inputs(self):
+		"""Update local values from the parameter inputs."""
+		# HACK: As mentioned above, we assume a single row and
+		# only update the column of the heart position
+		if self._heart_col != self.inputs.heart_pos:
+			self._update_heart_position(
+				self._heart_row, self.inputs.heart_pos)
+		# Update brightness based on input values.
+		if self._max_brightness != self.inputs.max_brightness:
+			self._max_brightness = self.inputs.max_brightness
+			self._led_values = self._compute_heart_values()
+		if ((self._red != self.inputs.red) or
+		    (self._green != self.inputs.green) or
+		    (self._blue != self.inputs.blue)):
+			self._update_color((self.inputs.red,
+					    self.inputs.green,
+					    self.inputs.blue))
+
 	def triggerSequence(self, *args):
 		if self.inputs.triggerSequence:
 			logging.info('HeartBeat.triggerSequence() called.')
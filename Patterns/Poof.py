@@ -21,6 +21,7 @@ class Chase(PatternBase):
 				'type' : 'pulse',
 				'subType' : 'timer',
 				'bindToFunction' : 'triggerStep',
+				'shared' : True, # stacked Chases run off one timer until one of them changes or refreshes it
 				'min' : 50,
 				'max' : 3000, 
 				'default' : 100
@@ -145,6 +146,7 @@ class RandomPoof(PatternBase):
 				'type' : 'multi',
 				'subType' : 'randomPulse',
 				'bindToFunction' : 'changePooferState',
+				'bindBatchToFunction' : 'changePooferStates',
 				'number' : gridSize[0] * gridSize[1]
 			},
 		}
@@ -156,5 +158,11 @@ class RandomPoof(PatternBase):
 		self.poofStates[index // self.gridSize[1]][index % self.gridSize[1]] = self.inputs.randomGenerator(index)
 		self.requestUpdate()
 
+	def changePooferStates(self, input, indices):
+		getValue = self.inputs.randomGenerator
+		for index in indices:
+			self.poofStates[index // self.gridSize[1]][index % self.gridSize[1]] = getValue(index)
+		self.requestUpdate()
+
 	def getState(self, row, col):
 		return self.poofStates[row][col]
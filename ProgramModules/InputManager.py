@@ -1,32 +1,61 @@
 ''' Builds collections of input objects based on defaults. Manages uses: Inputs
-can be used by multiple things, so this keeps track of who's using what and deletes unused inputs'''
+can be used by multiple things, so this keeps track of who's using what and deletes unused inputs
+
+A use is a (userId, inputChannelId, inputInstanceId) triple with a count, since global inputs can be registered
+by the same user more than once without a channel. Uses are indexed by instance, by user and by (user, channel),
+so registering and unregistering only touch the uses affected instead of every input.
+
+An input's use count is its reference count. It's stopped and freed as soon as its last use is unregistered.
+Inputs that are created and never registered(or whose registering failed) are caught by a periodic sweep: an input
+with no uses is marked on one sweep and freed on the next if it still has none, which leaves time for
+createNewInput's caller to register it.
+
+Input definitions with 'shared' : True in the pattern's inputParams are shared: every collection built with an
+identical definition uses the same live instance, so stacked patterns don't multiply timers or messages and shared
+timers keep them in phase. Sharing is copy-on-write, reassigning one pattern's channel only moves that pattern, and
+the first command a pattern sends to a shared input that others use(like a timer refresh) gives that pattern a
+private copy made by copyInput first. GUI writes to a shared input go through the pattern showing it
+(setPatternInputValue) for the same reason. Inputs aren't shared unless they ask to be.'''
+from threading import RLock
 import logging
 
 from ProgramModules import utils
+from ProgramModules.Timers import Timer
 import ProgramModules.sharedObjects as app
 import Inputs
 
 logger = logging.getLogger(__name__)
 
+patternSideInputKeys = ['descriptionInPattern', 'bindToFunction', 'bindBatchToFunction', 'channels', 'outParamIndex', 'shared', 'asyncDispatch'] # don't change the input itself, so don't stop sharing
+
 
 class InputManager():
-	def __init__ (self):
+	def __init__ (self, sweepInterval = 10000):
 		self.nextInputInstanceId = 1
 		self.inputInstances = {}
-		self.inputInstanceUses = {}
+		self.lock = RLock()
+		self.orphanCandidates = set()
+		self.sharedInputs = {} # fingerprint of the input definition -> inputInstanceId
+		self.inputShareKeys = {} # inputInstanceId -> fingerprint, for shared inputs
+		self.inputDefinitions = {} # inputInstanceId -> params it was created from
+		self.collectedInputCount = 0
+		self.usesByInstance = {} # inputInstanceId -> {(userId, inputChannelId) : count}
+		self.usesByUser = {} # userId -> {(inputChannelId, inputInstanceId) : count}
+		self.usesByUserChannel = {} # (userId, inputChannelId) -> {inputInstanceId : count}
 		self.availableInputTypes = {}
 		for inputType in Inputs.availableInputTypes:
 			self.availableInputTypes[inputType] = {}
 			for subType in Inputs.availableInputTypes[inputType]:
 				if not ('unavailable' in Inputs.inputTypes[' '.join([subType, inputType]).strip()].keys()):
 					self.availableInputTypes[inputType][subType] = Inputs.inputTypes[' '.join([subType, inputType]).strip()]
+		self.sweepTimer = Timer(True, sweepInterval, self.sweepOrphanedInputs)
 
 	def buildInputCollection(self, parentObj, inputParams):
 		inputDict = {}
 		channelsBoundToMulti = []
 		for inputChannelId in inputParams: #handle multi channels first
 			if inputParams[inputChannelId]['type'] == 'multi':
-				newInputInstanceId = self.createNewInput(inputParams[inputChannelId].copy())
+				newInputInstanceId = self.getSharedOrNewInput(inputParams[inputChannelId])
 				if 'channels' in inputParams[inputChannelId].keys(): #multi input that assigned to several non-multi channels
 					for i in range(len(inputParams[inputChannelId]['channels'])):
 						self.registerAndGetInput(parentObj.getId(), newInputInstanceId, inputParams[inputChannelId]['channels'][i])
@@ -37,7 +66,7 @@ class InputManager():
 					inputDict[inputChannelId] = {'inputObj' : inputObj, 'outParamIndex' : [i for i in range(len(inputObj.getCurrentStateData()['outParams']))]}
 		for inputChannelId in inputParams: #single channels
 			if not (inputParams[inputChannelId]['type'] == 'multi' or inputChannelId in channelsBoundToMulti):
-				newInputInstanceId = self.createNewInput(inputParams[inputChannelId].copy())
+				newInputInstanceId = self.getSharedOrNewInput(inputParams[inputChannelId])
 				if 'outParamIndex' in inputParams[inputChannelId].keys():
 					outParamIndex = inputParams[inputChannelId][outParamIndex]
 				else:
@@ -46,11 +75,45 @@ class InputManager():
 				self.registerAndGetInput(parentObj.getId(), newInputInstanceId, inputChannelId)
 		return InputCollection(parentObj, inputDict, inputParams)
 
+	def getShareKey(self, inputParams):
+		if not inputParams.get('shared', False):
+			return False
+		definition = dict([(key, inputParams[key]) for key in inputParams if not key in patternSideInputKeys])
+		try:
+			return utils.getFingerprint(definition)
+		except TypeError:
+			return False
+
+	def getSharedOrNewInput(self, inputParams):
+		shareKey = self.getShareKey(inputParams)
+		with self.lock:
+			if shareKey and self.sharedInputs.get(shareKey) in self.inputInstances:
+				return self.sharedInputs[shareKey]
+		newInputInstanceId = self.createNewInput(inputParams.copy())
+		if shareKey and newInputInstanceId:
+			with self.lock:
+				self.sharedInputs[shareKey] = newInputInstanceId
+				self.inputShareKeys[newInputInstanceId] = shareKey
+		return newInputInstanceId
+
+	def copyInput(self, inputInstanceId):
+		'''New unshared input made from the same definition, with the original's current input values'''
+		inputObj = self.getInputObj(inputInstanceId)
+		definition = utils.copyTree(self.inputDefinitions[inputInstanceId])
+		definition['shared'] = False
+		newInputInstanceId = self.createNewInput(definition)
+		newInputObj = self.getInputObj(newInputInstanceId)
+		for settingIndex in range(min(len(inputObj.inParams), len(newInputObj.inParams))):
+			newInputObj.setInputValue(inputObj.inParams[settingIndex].getValue(), settingIndex)
+		return newInputInstanceId
+
 	def createNewInput(self, params):
-		newInputInstanceId = self.nextInputInstanceId
-		self.nextInputInstanceId += 1
+		with self.lock: # patterns are also built on the pattern pool threads
+			newInputInstanceId = self.nextInputInstanceId
+			self.nextInputInstanceId += 1
+		definition = utils.copyTree(params)
 		inputTypeKey = ' '.join([params['subType'], params['type']]).strip()
-		params = utils.extendSettings(Inputs.inputTypes[inputTypeKey], params)
+		params = utils.extendSettings(Inputs.inputTypes[inputTypeKey], params, inputTypeKey)
 		if 'unavailable' in Inputs.inputTypes[inputTypeKey].keys():
 			return False
 		params['inputTypeKey'] = inputTypeKey
@@ -59,82 +122,231 @@ class InputManager():
 		else:
 			inputClassName = 'InputBase'
 		inputClass = getattr(Inputs, inputClassName)
-		self.inputInstances[newInputInstanceId] = inputClass(params, newInputInstanceId)
+		inputObj = inputClass(params, newInputInstanceId)
+		with self.lock:
+			self.inputInstances[newInputInstanceId] = inputObj
+			self.inputDefinitions[newInputInstanceId] = definition
 		return newInputInstanceId
 
 	def registerAndGetInput(self, userId, inputInstanceId, inputChannelId = False):
-		if inputChannelId:
-			self.unRegisterInputs(userId, inputChannelId = inputChannelId)
-		if not inputInstanceId in self.inputInstanceUses.keys():
-			self.inputInstanceUses[inputInstanceId] = []
-		self.inputInstanceUses[inputInstanceId].append([userId, inputChannelId])
-		return self.getInputObj(inputInstanceId)
+		with self.lock:
+			if inputChannelId:
+				self.unRegisterInputs(userId, inputChannelId = inputChannelId)
+			self.addUse(userId, inputChannelId, inputInstanceId)
+			return self.getInputObj(inputInstanceId)
+
+	def addUse(self, userId, inputChannelId, inputInstanceId):
+		for index, indexKey, useKey in [
+			(self.usesByInstance, inputInstanceId, (userId, inputChannelId)),
+			(self.usesByUser, userId, (inputChannelId, inputInstanceId)),
+			(self.usesByUserChannel, (userId, inputChannelId), inputInstanceId)
+		]:
+			uses = index.setdefault(indexKey, {})
+			uses[useKey] = uses.get(useKey, 0) + 1
+
+	def removeUse(self, userId, inputChannelId, inputInstanceId):
+		for index, indexKey, useKey in [
+			(self.usesByInstance, inputInstanceId, (userId, inputChannelId)),
+			(self.usesByUser, userId, (inputChannelId, inputInstanceId)),
+			(self.usesByUserChannel, (userId, inputChannelId), inputInstanceId)
+		]:
+			uses = index.get(indexKey, {})
+			uses.pop(useKey, None)
+			if not uses:
+				index.pop(indexKey, None)
 
 	def unRegisterInputs(self, userId, inputInstanceId = False, inputChannelId = False):
-		def unRegisterInputIfApplies(inputInstanceId):
-			def useMatches(useRecord):
-				return userId == useRecord[0] and (not inputChannelId or inputChannelId == useRecord[1])
-			self.inputInstanceUses[inputInstanceId][:] = [useRecord for useRecord in self.inputInstanceUses[inputInstanceId] if not useMatches(useRecord)]
-			if len(self.inputInstanceUses[inputInstanceId]) == 0:
-				if inputInstanceId in self.inputInstances.keys():
-					self.inputInstances[inputInstanceId].stop()
-					del self.inputInstances[inputInstanceId]
-
-		if not inputInstanceId:
-			for inputInstanceId in self.inputInstanceUses:
-				unRegisterInputIfApplies(inputInstanceId)
-		else:
-			unRegisterInputIfApplies(inputInstanceId)
+		with self.lock:
+			if inputInstanceId and inputChannelId:
+				uses = [(inputChannelId, inputInstanceId)] if (userId, inputChannelId) in self.usesByInstance.get(inputInstanceId, {}) else []
+			elif inputInstanceId:
+				uses = [(useKey[1], inputInstanceId) for useKey in self.usesByInstance.get(inputInstanceId, {}) if useKey[0] == userId]
+			elif inputChannelId:
+				uses = [(inputChannelId, useKey) for useKey in self.usesByUserChannel.get((userId, inputChannelId), {})]
+			else:
+				uses = self.usesByUser.get(userId, {}).keys()
+			for useChannelId, useInstanceId in uses:
+				self.removeUse(userId, useChannelId, useInstanceId)
+				if not useInstanceId in self.usesByInstance:
+					self.freeInput(useInstanceId)
+
+	def getUseCount(self, inputInstanceId):
+		return sum(self.usesByInstance.get(inputInstanceId, {}).values())
+
+	def isSharedWithOthers(self, inputInstanceId, userId):
+		with self.lock:
+			return inputInstanceId in self.inputShareKeys and any([not useKey[0] == userId for useKey in self.usesByInstance.get(inputInstanceId, {})])
+
+	def isSharedInUse(self, inputInstanceId): # shared and used by more than one user
+		with self.lock:
+			return inputInstanceId in self.inputShareKeys and len(set([useKey[0] for useKey in self.usesByInstance.get(inputInstanceId, {})])) > 1
+
+	def freeInput(self, inputInstanceId):
+		inputObj = self.inputInstances.pop(inputInstanceId, False)
+		self.inputDefinitions.pop(inputInstanceId, None)
+		shareKey = self.inputShareKeys.pop(inputInstanceId, False)
+		if shareKey and self.sharedInputs.get(shareKey) == inputInstanceId:
+			del self.sharedInputs[shareKey]
+		if inputObj:
+			inputObj.stop()
+
+	def sweepOrphanedInputs(self):
+		with self.lock:
+			orphans = set([inputInstanceId for inputInstanceId in self.inputInstances if not inputInstanceId in self.usesByInstance])
+			for inputInstanceId in orphans & self.orphanCandidates:
+				logger.info('freeing input %s, it has had no uses since the last sweep', inputInstanceId)
+				self.freeInput(inputInstanceId)
+				self.collectedInputCount += 1
+			self.orphanCandidates = orphans - self.orphanCandidates
+
+	def stop(self):
+		self.sweepTimer.stop()
+		with self.lock:
+			for inputInstanceId in self.inputInstances.keys():
+				self.freeInput(inputInstanceId)
 
 	def getCurrentStateData(self):
 		currentInputData = {}
-		for inputInstanceId in self.inputInstances:
-			currentInputData[inputInstanceId] = self.inputInstances[inputInstanceId].getCurrentStateData()
-		data = {'inputs' : currentInputData, 'availableInputTypes' : self.availableInputTypes}
+		with self.lock:
+			for inputInstanceId in self.inputInstances:
+				currentInputData[inputInstanceId] = self.getInputStateData(self.inputInstances[inputInstanceId], self.getUseCount(inputInstanceId), inputInstanceId in self.inputShareKeys)
+		return {'inputs' : currentInputData, 'availableInputTypes' : self.availableInputTypes, 'inputLifetimes' : self.getInputLifetimes()}
+
+	def getStateFragments(self): # per input fragments for the state snapshot, see StateSnapshots
+		fragments = []
+		with self.lock:
+			for inputInstanceId in self.inputInstances:
+				inputObj = self.inputInstances[inputInstanceId]
+				useCount = self.getUseCount(inputInstanceId)
+				shared = inputInstanceId in self.inputShareKeys
+				getData = lambda inputObj = inputObj, useCount = useCount, shared = shared: self.getInputStateData(inputObj, useCount, shared)
+				fragments.append((('inputs', inputInstanceId), (id(inputObj), inputObj.getStateVersion(), useCount, shared), getData))
+		fragments.append((('availableInputTypes',), id(self), lambda: self.availableInputTypes))
+		fragments.append((('inputLifetimes',), None, self.getInputLifetimes))
+		return fragments
+
+	def getInputStateData(self, inputObj, useCount, shared):
+		data = inputObj.getCurrentStateData()
+		data['useCount'] = useCount
+		data['shared'] = shared
 		return data
 
+	def getInputLifetimes(self):
+		return {'liveInputs' : len(self.inputInstances), 'orphanedInputs' : len(self.orphanCandidates), 'collectedInputs' : self.collectedInputCount, 'sharedInputs' : len(self.sharedInputs)}
+
 	def getInputObj(self, inputInstanceId):
 		return self.inputInstances[inputInstanceId]
 
 class InputCollection(object): #a package of all the inputs used by a module or pattern instance
+	'''Reading self.inputs.someChannel goes through an accessor compiled for that channel when the collection is
+	built or the channel is reassigned, and kept in self.accessors. Collections with the same channel ids share one
+	subclass with a property per channel that calls its accessor, __getattr__ is the slower fallback.'''
 	def __init__(self, parentObj, inputCollection, inputParams):
+		self.__class__ = getAccessorClass(inputCollection.keys())
+		self.accessors = {}
 		self.inputCollection = inputCollection
 		self.inputParams = inputParams
 		self.parentObj = parentObj
 		self.messengerBindingIds = {}
+		self.assignmentVersion = 0
 		for inputChannelId in inputParams:
+			self.compileAccessor(inputChannelId)
 			self.addMessengerBindingsIfNeeded(inputChannelId)
 
-	def __getattr__(self, inputChannelId):
-		if isinstance(self.inputCollection[inputChannelId]['outParamIndex'], list):
-			return self.inputCollection[inputChannelId]['inputObj'].getValue
+	def compileAccessor(self, inputChannelId):
+		if not inputChannelId in self.inputCollection:
+			return
+		inputObj = self.inputCollection[inputChannelId]['inputObj']
+		outParamIndex = self.inputCollection[inputChannelId]['outParamIndex']
+		if isinstance(outParamIndex, list):
+			getValue = inputObj.getValue
+			self.accessors[inputChannelId] = lambda: getValue
+		elif inputObj.pushesOutputValues:
+			outParam = inputObj.outParams[outParamIndex]
+			self.accessors[inputChannelId] = lambda: outParam.value
 		else:
-			return self.inputCollection[inputChannelId]['inputObj'].getValue(self.inputCollection[inputChannelId]['outParamIndex'])
+			getValue = inputObj.getValue
+			self.accessors[inputChannelId] = lambda: getValue(outParamIndex)
+
+	def __getattr__(self, inputChannelId): # only called for names that aren't normal attributes or properties
+		try:
+			accessor = self.__dict__['accessors'][inputChannelId]
+		except KeyError:
+			raise AttributeError(inputChannelId)
+		return accessor()
+
+	def getVersion(self, inputChannelIds = False): # changes whenever any of the inputs (or the given channels' inputs) change or get reassigned
+		if not inputChannelIds:
+			inputChannelIds = self.inputCollection.keys()
+		return (self.assignmentVersion,) + tuple([self.inputCollection[inputChannelId]['inputObj'].getVersion() for inputChannelId in inputChannelIds])
 
 	def getInputAssignment(self, inputChannelId):
 		return [self.inputCollection[inputChannelId]['inputObj'].getId(), self.inputCollection[inputChannelId]['outParamIndex']]
 
 	def doCommand(self, args):
-		function = getattr(self.inputCollection[args.pop(0)]['inputObj'], args.pop(0))
+		inputChannelId = args.pop(0)
+		inputInstanceId = self.getInputAssignment(inputChannelId)[0]
+		if app.inputManager.isSharedWithOthers(inputInstanceId, self.parentObj.getId()):
+			self.unshareInput(inputInstanceId)
+		function = getattr(self.inputCollection[inputChannelId]['inputObj'], args.pop(0))
 		return function(*args)
 
+	def unshareInput(self, inputInstanceId): # moves every channel using a shared input onto one private copy of it
+		copyInstanceId = app.inputManager.copyInput(inputInstanceId)
+		for inputChannelId in self.inputCollection.keys():
+			if self.getInputAssignment(inputChannelId)[0] == inputInstanceId:
+				self.reassignInput(inputChannelId, copyInstanceId, self.inputCollection[inputChannelId]['outParamIndex'])
+		return copyInstanceId
+
+	def setInputValue(self, inputInstanceId, *args): # writes from outside the parent, like GUI controls, with the same copy-on-write as doCommand
+		if app.inputManager.isSharedWithOthers(inputInstanceId, self.parentObj.getId()):
+			inputInstanceId = self.unshareInput(inputInstanceId)
+		app.inputManager.getInputObj(inputInstanceId).setInputValue(*args)
+
 	def reassignInput (self, inputChannelId, inputInstanceId, outParamIndex = 0):
 		inputObj = app.inputManager.registerAndGetInput(self.parentObj.getId(), inputInstanceId, inputChannelId)
 		self.inputCollection[inputChannelId]['inputObj'] = inputObj
 		self.inputCollection[inputChannelId]['outParamIndex'] = outParamIndex
+		self.assignmentVersion += 1
+		self.compileAccessor(inputChannelId)
 		self.removeExistingMessengerBindings(inputChannelId)
 		self.addMessengerBindingsIfNeeded(inputChannelId)
 
 	def addMessengerBindingsIfNeeded(self, inputChannelId):
-		if 'bindToFunction' in self.inputParams[inputChannelId].keys():
+		if 'bindToFunction' in self.inputParams[inputChannelId].keys() or 'bindBatchToFunction' in self.inputParams[inputChannelId].keys():
 			inputAssignment = self.getInputAssignment(inputChannelId)
+			inputObj = self.inputCollection[inputChannelId]['inputObj']
+			if hasattr(inputObj, 'batchChannelId'): # input publishes all its changed channels in one message
+				self.messengerBindingIds[inputChannelId] = app.messenger.addBinding(inputObj.batchChannelId, self.dispatchChangeBatch, (inputChannelId,))
+				return
+			if not 'bindToFunction' in self.inputParams[inputChannelId].keys():
+				return
 			function = getattr(self.parentObj, self.inputParams[inputChannelId]['bindToFunction'])
 			logging.debug('addMessengerBindingsIfNeeded(%s): %s',
 				      inputChannelId, function)
 			if isinstance(inputAssignment[1], list):
-				self.messengerBindingIds[inputChannelId] = [app.messenger.addBinding('output%s_%s' %(inputAssignment[0], i), function, (inputChannelId, i)) for i in range(len(inputAssignment[1]))]
+				channelIds = ['output%s_%s' %(inputAssignment[0], i) for i in range(len(inputAssignment[1]))]
+				self.messengerBindingIds[inputChannelId] = [app.messenger.addBinding(channelIds[i], function, (inputChannelId, i)) for i in range(len(inputAssignment[1]))]
 			else:
-				self.messengerBindingIds[inputChannelId] = app.messenger.addBinding('output%s_%s' %(inputAssignment[0], inputAssignment[1]), function, (inputChannelId,  inputAssignment[1]))
+				channelIds = ['output%s_%s' %(inputAssignment[0], inputAssignment[1])]
+				self.messengerBindingIds[inputChannelId] = app.messenger.addBinding(channelIds[0], function, (inputChannelId,  inputAssignment[1]))
+			if self.inputParams[inputChannelId].get('asyncDispatch'): # the channel stays async for its other subscribers too
+				for channelId in channelIds:
+					app.messenger.setAsyncDispatch(channelId, True)
+
+	def dispatchChangeBatch(self, inputChannelId):
+		changedIndices = self.inputCollection[inputChannelId]['inputObj'].getChangedIndices()
+		outParamIndex = self.inputCollection[inputChannelId]['outParamIndex']
+		if not isinstance(outParamIndex, list):
+			changedIndices = [index for index in changedIndices if index == outParamIndex]
+		if not changedIndices:
+			return
+		if 'bindBatchToFunction' in self.inputParams[inputChannelId].keys():
+			getattr(self.parentObj, self.inputParams[inputChannelId]['bindBatchToFunction'])(inputChannelId, changedIndices)
+		else:
+			function = getattr(self.parentObj, self.inputParams[inputChannelId]['bindToFunction'])
+			for index in changedIndices:
+				function(inputChannelId, index)
 
 	def removeExistingMessengerBindings(self, inputChannelId):
 		if inputChannelId in self.messengerBindingIds.keys():
@@ -159,3 +371,18 @@ class InputCollection(object): #a package of all the inputs used by a module or
 			self.removeExistingMessengerBindings(inputChannelId)
 		app.inputManager.unRegisterInputs(self.parentObj.getId())
 		self.parentObj = False
+
+collectionAttributes = ['accessors', 'inputCollection', 'inputParams', 'parentObj', 'messengerBindingIds', 'assignmentVersion']
+accessorClasses = {} # frozenset of channel ids -> InputCollection subclass with their properties
+accessorClassesLock = RLock()
+
+def getAccessorClass(inputChannelIds):
+	key = frozenset(inputChannelIds)
+	with accessorClassesLock:
+		if not key in accessorClasses:
+			properties = dict([(inputChannelId, makeAccessorProperty(inputChannelId)) for inputChannelId in key if not (hasattr(InputCollection, inputChannelId) or inputChannelId in collectionAttributes)])
+			accessorClasses[key] = type('InputCollection', (InputCollection,), properties)
+		return accessorClasses[key]
+
+def makeAccessorProperty(inputChannelId):
+	return property(lambda collection: collection.accessors[inputChannelId]())
@@ -3,71 +3,328 @@ Messenger is an interface for all objects in the program to communicate with eac
 It can have an arbitrary number of "channels". Any object can put a message on any channel,
 and other objects can either check the channel for messages on their own, or bind a function that
 will be called when a message appears on the channel.
+
+Channels are interned: getChannel always returns the same Channel object for a channel id, so
+frequent publishers can look their channel up once and call publish on it directly. Publishers make their channel
+when they first need it and hand it back with releaseChannel when they stop, so the registry only holds live ones. Each channel
+keeps its bindings as a prebuilt tuple of (function, data, bindingId) entries that is only rebuilt when a binding
+is added or removed.
+
+By default bound functions are called synchronously on the publisher's thread. A channel can opt in to
+asynchronous dispatch with setAsyncDispatch, so its bound functions run on a small shared worker pool
+and a slow subscriber can't stall publishers. Each async channel has a bounded number of pending
+dispatches. When that is full, further publishes are either coalesced into the pending dispatch
+('coalesce', subscribers still get every queued message through getMessages) or dropped ('drop', the message
+isn't queued at all). Safety critical channels should stay synchronous. Inputs opt their output channels in with
+'asyncDispatch' : True in the input params of whatever binds to them, InputOnlyModule does this for its inputs so
+the serial writes it does on every change don't run on the OSC or audio threads.
+
+Messages are kept in a fixed capacity ring buffer per channel, so a queued channel nobody reads with
+getMessages can't grow without bound. When a queued channel is full the oldest message is dropped and
+counted. Channels that don't queue only keep their latest message.
+
+Instrumentation is opt-in through setInstrumentation. While it's on, every channel counts its publishes
+and times every call to its bound functions, and getSlowestHandlers reports the bindings that used the
+most time. While it's off, publish only pays for one flag check.
 '''
 
+from threading import Thread, Lock
+from collections import deque
+from timeit import default_timer
+import Queue
 import logging
+import sys
 
 logger = logging.getLogger(__name__)
 
 
+class DispatchPool():
+	class WorkerThread(Thread):
+		def __init__(self, parent, workerIndex):
+			Thread.__init__(self, name = 'MessengerDispatch%s' %(workerIndex))
+			self.daemon = True
+			self.parent = parent
+		def run(self):
+			self.parent.runWorker()
+
+	def __init__(self, numThreads):
+		self.numThreads = numThreads
+		self.readyChannels = Queue.Queue()
+		self.threads = []
+		self.startLock = Lock()
+
+	def put(self, channel):
+		if not self.threads:
+			with self.startLock:
+				while len(self.threads) < self.numThreads:
+					self.threads.append(DispatchPool.WorkerThread(self, len(self.threads)))
+					self.threads[-1].start()
+		self.readyChannels.put(channel)
+
+	def runWorker(self):
+		while True:
+			self.readyChannels.get().runPendingDispatches()
+
+
+class Channel():
+	def __init__(self, channelId, messageCapacity, instrumented = False):
+		self.channelId = channelId
+		self.defaultMessageCapacity = messageCapacity
+		self.dispatchLock = Lock()
+		self.reset()
+		self.setInstrumentation(instrumented)
+
+	def reset(self):
+		self.bindings = {}
+		self.callbacks = ()
+		self.queueMessages = True
+		self.messageCapacity = self.defaultMessageCapacity
+		self.messages = deque(maxlen = self.messageCapacity)
+		self.droppedMessages = 0
+		self.dispatchPool = False
+		self.overflowPolicy = 'coalesce'
+		self.maxPendingDispatches = 1
+		self.pendingDispatches = 0
+		self.dispatchScheduled = False
+		self.dispatchCounts = {'requested' : 0, 'dispatched' : 0, 'coalesced' : 0, 'dropped' : 0, 'maxPending' : 0}
+		self.instrumented = False
+		self.bindingStats = {}
+
+	def publish(self, message):
+		if self.dispatchPool:
+			self.requestDispatch(message)
+			return
+		self.queueMessage(message)
+		if self.instrumented:
+			self.publishCount += 1
+			self.callCallbacksTimed()
+			return
+		for function, data, bindingId in self.callbacks:
+			if data:
+				function(*data)
+			else:
+				function()
+
+	def setAsyncDispatch(self, dispatchPool, overflowPolicy, maxPendingDispatches):
+		self.dispatchPool = dispatchPool
+		self.overflowPolicy = overflowPolicy
+		self.maxPendingDispatches = max(maxPendingDispatches, 1)
+
+	def queueMessage(self, message):
+		if self.queueMessages and len(self.messages) == self.messageCapacity:
+			self.droppedMessages += 1
+		self.messages.append(message)
+
+	def requestDispatch(self, message):
+		with self.dispatchLock:
+			if self.instrumented:
+				self.publishCount += 1
+			self.dispatchCounts['requested'] += 1
+			if self.pendingDispatches >= self.maxPendingDispatches:
+				if self.overflowPolicy == 'coalesce':
+					self.dispatchCounts['coalesced'] += 1
+					self.queueMessage(message)
+				else: # the message is thrown away, subscribers never see it
+					self.dispatchCounts['dropped'] += 1
+				return
+			self.queueMessage(message)
+			self.pendingDispatches += 1
+			self.dispatchCounts['maxPending'] = max(self.dispatchCounts['maxPending'], self.pendingDispatches)
+			if self.dispatchScheduled:
+				return
+			self.dispatchScheduled = True
+		self.dispatchPool.put(self)
+
+	def runPendingDispatches(self): # only ever runs on one worker at a time per channel, so order is kept
+		while True:
+			with self.dispatchLock:
+				if not self.pendingDispatches:
+					self.dispatchScheduled = False
+					return
+				self.pendingDispatches -= 1
+				self.dispatchCounts['dispatched'] += 1
+			if self.instrumented:
+				try:
+					self.callCallbacksTimed()
+				except Exception:
+					logger.exception('async dispatch of %s failed', self.channelId)
+				continue
+			for function, data, bindingId in self.callbacks:
+				try:
+					if data:
+						function(*data)
+					else:
+						function()
+				except Exception:
+					logger.exception('async dispatch of %s to %s failed', self.channelId, function)
+
+	def callCallbacksTimed(self):
+		for function, data, bindingId in self.callbacks:
+			startTime = default_timer()
+			try:
+				if data:
+					function(*data)
+				else:
+					function()
+			finally:
+				elapsed = default_timer() - startTime
+				stats = self.bindingStats.setdefault(bindingId, {'calls' : 0, 'totalTime' : 0., 'maxTime' : 0.})
+				stats['calls'] += 1
+				stats['totalTime'] += elapsed
+				stats['maxTime'] = max(stats['maxTime'], elapsed)
+
+	def setInstrumentation(self, value):
+		self.bindingStats = {}
+		self.publishCount = 0
+		self.instrumentedSince = default_timer()
+		self.instrumented = value
+
+	def getPublishRate(self):
+		elapsed = default_timer() - self.instrumentedSince
+		return self.publishCount / elapsed if elapsed > 0 else 0
+
+	def addBinding(self, bindingId, function, data):
+		self.bindings[bindingId] = {'function' : function, 'data' : data}
+		self.rebuildCallbacks()
+
+	def removeBinding(self, bindingId):
+		if bindingId in self.bindings:
+			del self.bindings[bindingId]
+			self.bindingStats.pop(bindingId, None)
+			self.rebuildCallbacks()
+			return True
+		return False
+
+	def rebuildCallbacks(self):
+		self.callbacks = tuple([(self.bindings[bindingId]['function'], self.bindings[bindingId]['data'], bindingId) for bindingId in sorted(self.bindings)])
+
+	def setQueuing(self, queueMessages, messageCapacity = False):
+		self.queueMessages = queueMessages
+		if messageCapacity:
+			self.messageCapacity = messageCapacity
+		self.messages = deque(self.messages, maxlen = self.messageCapacity if queueMessages else 1)
+
+	def takeMessages(self):
+		data = self.messages
+		self.messages = deque(maxlen = data.maxlen)
+		return list(data)
+
+	def getMemoryUsage(self):
+		messages = list(self.messages)
+		return {
+			'queuedMessages' : len(messages),
+			'messageCapacity' : self.messages.maxlen,
+			'droppedMessages' : self.droppedMessages,
+			'approxBytes' : sys.getsizeof(self.messages) + sum([sys.getsizeof(message) for message in messages])
+		}
+
+
 class Messenger():
-	def __init__(self):
+	def __init__(self, dispatchThreads = 2, messageCapacity = 1000):
 		self.channels = {}
+		self.bindingChannels = {} # bindingId -> Channel, so removeBinding doesn't have to search
 		self.nextBindingId = 1
+		self.messageCapacity = messageCapacity
+		self.instrumented = False
+		self.dispatchPool = DispatchPool(dispatchThreads)
+		self.bindingLock = Lock() # patterns can be built on a background thread while requests add bindings
+
+
+	def getChannel(self, channelId):
+		try:
+			return self.channels[channelId]
+		except KeyError: # setdefault so two threads making the same channel end up with one
+			return self.channels.setdefault(channelId, Channel(channelId, self.messageCapacity, self.instrumented))
 
 
 	def putMessage(self, channelId, message):
 		logger.debug('putMessage(%s, %s)', channelId, message)
-		self.checkForChannel(channelId)
-		if self.channels[channelId]['queueMessages']:
-			self.channels[channelId]['messages'].append(message)
-		else:
-			self.channels[channelId]['messages'] = [message]
-		for bindingId in self.channels[channelId]['bindings']:
-			function = self.channels[channelId]['bindings'][bindingId]['function']
-			data = self.channels[channelId]['bindings'][bindingId]['data']
-			logger.debug('calling %s with %s', function, data)
-			if data:
-				function(*data)
-			else:
-				function()
+		self.getChannel(channelId).publish(message)
 
 
 	def getMessages(self, channelId):
-		self.checkForChannel(channelId)
-		data = self.channels[channelId]['messages']
-		self.channels[channelId]['messages'] = []
-		return data
+		return self.getChannel(channelId).takeMessages()
 
 
 	def addBinding(self, channelId, function, data=False):
-		self.checkForChannel(channelId)
-		newBindingId = self.nextBindingId
-		binding = {'function' : function, 'data' : data}
-		self.channels[channelId]['bindings'][newBindingId] = binding
-		self.nextBindingId += 1
+		with self.bindingLock:
+			newBindingId = self.nextBindingId
+			channel = self.getChannel(channelId)
+			channel.addBinding(newBindingId, function, data)
+			self.bindingChannels[newBindingId] = channel
+			self.nextBindingId += 1
 		return newBindingId
 
 
 	def removeBinding(self, bindingId):
-		for channelId in self.channels:
-			if bindingId in self.channels[channelId]['bindings']:
-				del self.channels[channelId]['bindings'][bindingId]
+		with self.bindingLock:
+			channel = self.bindingChannels.pop(bindingId, False)
+			if channel:
+				channel.removeBinding(bindingId)
 
 
+	def releaseChannel(self, channelId): # drops the channel of a publisher that's gone, a later getChannel makes a fresh one
+		self.channels.pop(channelId, None)
+
 	def checkForChannel(self, channelId):
-		if not channelId in self.channels.keys():
-			self.channels[channelId] = {'messages' : [], 'bindings' : {}, 'queueMessages' : True}
+		self.getChannel(channelId)
+
+	def setQueuing(self, channelId, value, messageCapacity = False):
+		self.getChannel(channelId).setQueuing(value, messageCapacity)
+
+	def setAsyncDispatch(self, channelId, value, overflowPolicy = 'coalesce', maxPendingDispatches = 1):
+		self.getChannel(channelId).setAsyncDispatch(value and self.dispatchPool, overflowPolicy, maxPendingDispatches)
 
-	def setQueuing(self, channelId, value):
-		self.checkForChannel(channelId)
-		self.channels[channelId]['queueMessages'] = value
+	def setInstrumentation(self, value):
+		self.instrumented = value
+		for channelId, channel in self.getChannelItems():
+			channel.setInstrumentation(value)
+
+	def getSlowestHandlers(self, limit = 10):
+		report = []
+		for channelId, channel in self.getChannelItems():
+			bindings = channel.bindings
+			for bindingId, bindingStats in channel.bindingStats.items():
+				binding = bindings.get(bindingId)
+				if binding:
+					stats = dict(bindingStats)
+					stats['meanTime'] = stats['totalTime'] / stats['calls'] if stats['calls'] else 0
+					stats['bindingId'] = bindingId
+					stats['channelId'] = channelId
+					stats['function'] = describeFunction(binding['function'])
+					report.append(stats)
+		report.sort(key = lambda stats: stats['totalTime'], reverse = True)
+		return report[:limit]
+
+	def getPublishRates(self):
+		return {channelId : channel.getPublishRate() for channelId, channel in self.getChannelItems() if channel.publishCount}
+
+	def getChannelItems(self): # a snapshot, other threads make and release channels while reports go through them
+		return list(self.channels.items())
 
 	def doReset(self):
+		for channelId, channel in self.getChannelItems(): # detach handles that publishers may still be holding
+			channel.reset()
 		self.channels = {}
+		self.bindingChannels = {}
 		self.nextBindingId = 1
 	def getCurrentStateData(self):
 		data = {}
-		for channelId in self.channels:
-			data[channelId] = self.channels[channelId]['bindings'].keys()
+		for channelId, channel in self.getChannelItems():
+			data[channelId] = {'bindings' : channel.bindings.keys(), 'async' : bool(channel.dispatchPool), 'memory' : channel.getMemoryUsage()}
+			if self.instrumented:
+				data[channelId]['publishRate'] = channel.getPublishRate()
+			if channel.dispatchPool:
+				data[channelId]['overflowPolicy'] = channel.overflowPolicy
+				data[channelId]['maxPendingDispatches'] = channel.maxPendingDispatches
+				data[channelId]['pendingDispatches'] = channel.pendingDispatches
+				data[channelId]['dispatchCounts'] = channel.dispatchCounts.copy()
 		return data
+
+
+def describeFunction(function):
+	name = getattr(function, '__name__', repr(function))
+	owner = getattr(function, 'im_self', None)
+	if owner is not None:
+		return '%s.%s' %(owner.__class__.__name__, name)
+	return name
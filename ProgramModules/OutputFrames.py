@@ -0,0 +1,108 @@
+'''Compact binary frames of the modules' output state, for the GUI's websocket stream.
+
+Every frame starts with a 6 byte header, big-endian: frame type(1 byte, KEYFRAME or DELTA), module index(1 byte,
+the module's place in the stream's module list) and frame number(4 bytes, counts up by one for every frame of that
+module). Grids are sent as gridSize rows x cols, row by row, with items missing from short rows sent as off.
+	poofer grids: a keyframe is a bitset of the grid, most significant bit first, one bit per item that's on.
+		a delta is the same size bitset with the items that flipped since the last frame set.
+	LED grids: a keyframe is 3 bytes(r, g, b) per item. A delta is a 2 byte count followed by 2 byte item index, r, g,
+		b for each item that changed. When that would be bigger than a keyframe, a keyframe is sent instead.
+A delta only applies on top of the frame numbered one before it, so a client that missed a frame waits for the next
+keyframe.
+'''
+import struct
+
+KEYFRAME = 0
+DELTA = 1
+headerFormat = '>BBI'
+
+
+class GridFrameEncoder():
+	'''Makes frames for one module. update() reads the module's current output state, and returns the delta from
+	the last frame(False when nothing changed). getKeyframe() is the latest frame in full'''
+	def __init__(self, module, moduleIndex):
+		self.module = module
+		self.moduleId = module.moduleConfig['moduleId']
+		self.moduleIndex = moduleIndex
+		self.rows, self.cols = module.gridSize
+		self.frameNumber = 0
+		self.frame = self.encodeGrid([[False] * self.cols for row in range(self.rows)])
+		self.keyframe = False
+		self.stateVersion = -1
+
+	def getDescription(self):
+		return {'moduleId' : self.moduleId, 'index' : self.moduleIndex, 'kind' : self.kind, 'rows' : self.rows, 'cols' : self.cols}
+
+	def update(self):
+		stateVersion = self.module.stateVersion
+		if stateVersion == self.stateVersion:
+			return False
+		self.stateVersion = stateVersion
+		frame = self.encodeGrid(self.module.currentOutputState)
+		if frame == self.frame:
+			return False
+		delta = self.makeDelta(self.frame, frame)
+		self.frame = frame
+		self.frameNumber += 1
+		self.keyframe = False
+		if delta is False:
+			return self.getKeyframe()
+		return struct.pack(headerFormat, DELTA, self.moduleIndex, self.frameNumber) + delta
+
+	def getKeyframe(self):
+		if not self.keyframe:
+			self.keyframe = struct.pack(headerFormat, KEYFRAME, self.moduleIndex, self.frameNumber) + str(self.frame)
+		return self.keyframe
+
+	def getItems(self, outputState): # every item of the grid, row by row, with short rows filled out
+		for row in range(self.rows):
+			rowState = outputState[row]
+			for col in range(self.cols):
+				yield rowState[col] if col < len(rowState) else False
+
+
+class PooferFrameEncoder(GridFrameEncoder):
+	kind = 'poofer'
+
+	def encodeGrid(self, outputState):
+		data = bytearray((self.rows * self.cols + 7) // 8)
+		for index, state in enumerate(self.getItems(outputState)):
+			if state:
+				data[index >> 3] |= 0x80 >> (index & 7)
+		return data
+
+	def makeDelta(self, lastFrame, frame):
+		return str(bytearray([lastByte ^ byte for lastByte, byte in zip(lastFrame, frame)]))
+
+
+class LEDFrameEncoder(GridFrameEncoder):
+	kind = 'led'
+
+	def encodeGrid(self, outputState):
+		data = bytearray(self.rows * self.cols * 3)
+		for index, state in enumerate(self.getItems(outputState)):
+			if state:
+				data[index * 3 : index * 3 + 3] = getColor(state)
+		return data
+
+	def makeDelta(self, lastFrame, frame):
+		changes = []
+		for index in range(0, len(frame), 3):
+			if not frame[index : index + 3] == lastFrame[index : index + 3]:
+				changes.append(struct.pack('>H', index // 3) + str(frame[index : index + 3]))
+		if len(changes) * 5 + 2 >= len(frame):
+			return False
+		return struct.pack('>H', len(changes)) + ''.join(changes)
+
+def getColor(state): # LED states are (r, g, b), anything else that's on(like an image id) shows as white
+	try:
+		return bytearray([max(0, min(255, int(value))) for value in state[:3]])
+	except TypeError:
+		return bytearray([255, 255, 255])
+
+def makeFrameEncoder(module, moduleIndex): # False for modules with no output grid
+	if not hasattr(module, 'currentOutputState'):
+		return False
+	if module.moduleConfig.get('patternType') == 'LED':
+		return LEDFrameEncoder(module, moduleIndex)
+	return PooferFrameEncoder(module, moduleIndex)
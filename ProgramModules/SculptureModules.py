@@ -1,22 +1,44 @@
 '''Runs and overlays patterns, communicates pattern data to DataChannelManager. Is the basic building block of
 stuff that does things on sculptures.
+
+Grid modules can keep a warm pool of ready-but-idle pattern instances('warmPoolSize' per pattern type in the module
+config, or setWarmPoolSize). addPattern then just hands a pooled instance over, and a background thread builds its
+replacement. Pooled patterns are built with their own instance ids and run their inputs, but their updates are
+ignored until they go live. The time from each addPattern to the pattern's first frame is recorded.
+
+suspendUpdates holds back output while a batch of commands runs, so it goes out as one update. Only things
+turning on are held: offs(auto-off timers, safe mode, patterns ending) are always sent at once, and a batch that
+takes longer than maxSuspendTime stops holding anything back.
 '''
+from collections import deque
 from copy import deepcopy
+from threading import Thread, Lock
+from timeit import default_timer
+import Queue
 import json
 import logging
-import traceback
 
-from ProgramModules.Timers import Timer
+from ProgramModules.Timers import Timer, monotonicTime
 import ProgramModules.sharedObjects as app
 
 logger = logging.getLogger(__name__)
 
+maxSuspendTime = 0.25 # s
+
 
 class SculptureModuleBase():
 	def __init__ (self, moduleConfig):
 		self.initialized = False
 		self.moduleConfig = deepcopy(moduleConfig)
 		self.refreshTimer = False
+		self.stateVersion = 0 # goes up after anything in getCurrentStateData changes
+		self.stateVersionLock = Lock()
+		self.updatesSuspended = 0
+		self.updatePending = False
+		self.suspendedSince = 0
+		self.suspendLock = Lock()
+
+	def startRefreshTimer(self): # called once the module is built, so resendOnStates never sees it half set up
 		if 'resendDataInterval' in self.moduleConfig['protocol'].keys() and self.moduleConfig['protocol']['resendDataInterval']:
 			self.refreshTimer = Timer(True, self.moduleConfig['protocol']['resendDataInterval'], self.resendOnStates)
 
@@ -24,27 +46,81 @@ class SculptureModuleBase():
 		if self.refreshTimer:
 			self.refreshTimer.stop()
 
+	def markStateChanged(self): # request, timer and pattern pool threads all do this
+		with self.stateVersionLock:
+			self.stateVersion += 1
+
+	def suspendUpdates(self): # output turning on is held back until the matching resumeUpdates, then sent as one update
+		with self.suspendLock:
+			if not self.updatesSuspended:
+				self.suspendedSince = monotonicTime()
+			self.updatesSuspended += 1
+
+	def resumeUpdates(self):
+		with self.suspendLock:
+			self.updatesSuspended -= 1
+			flush = not self.updatesSuspended and self.updatePending
+			if flush:
+				self.updatePending = False
+		if flush:
+			self.flushUpdates()
+
+	def isHoldingUpdates(self): # True(and the update is marked pending) while a batch that hasn't run too long holds output back
+		with self.suspendLock:
+			if not self.updatesSuspended or monotonicTime() - self.suspendedSince > maxSuspendTime:
+				return False
+			self.updatePending = True
+			return True
+
+	def flushUpdates(self):
+		pass
+
 
 	def doCommand(self, command):
 		logger.debug('doCommand(%s)', command)
 		functionName = command.pop(0)
 		function = getattr(self, functionName)
-		return function(*command)
+		try:
+			return function(*command)
+		finally:
+			self.markStateChanged()
 
 	def getId(self):
 		return self.moduleConfig['moduleId'] + 'Module'
 
 
 class GridPatternModule(SculptureModuleBase):
+	class PatternPoolThread(Thread):
+		def __init__(self, parent):
+			Thread.__init__(self, name = 'PatternPool')
+			self.daemon = True
+			self.parent = parent
+			self.requests = Queue.Queue()
+		def run(self):
+			while True:
+				patternTypeId = self.requests.get()
+				if patternTypeId is False:
+					return
+				try:
+					self.parent.addWarmPattern(patternTypeId)
+				except Exception:
+					logger.exception('building warm %s pattern failed', patternTypeId)
+
 	def __init__(self, *args):
 		SculptureModuleBase.__init__(self, *args)
 		self.nextPatternInstanceId = 0
+		self.poolLock = Lock()
+		self.warmPatterns = {} # patternTypeId -> [pattern, ...] built and idle
+		self.warmPoolSize = 0
+		self.poolThread = False
+		self.addLatencies = deque(maxlen = 50)
 		patternModuleName = 'Patterns.' + self.moduleConfig['patternType']
 		patternClasses = __import__(patternModuleName)
 		self.availablePatternClasses = {}
 		self.availablePatternNames = []
 		self.patterns = {}
 		self.patternRowSettings = {}
+		self.itemOffTimers = {}
 		self.gridSize = [len(self.moduleConfig['protocol']['mapping']), max([len(self.moduleConfig['protocol']['mapping'][i]) for i in range(len(self.moduleConfig['protocol']['mapping']))])]
 		for patternTypeId in self.moduleConfig['patterns']:
 			try:
@@ -52,11 +128,20 @@ class GridPatternModule(SculptureModuleBase):
 				self.availablePatternNames.append(patternTypeId)
 			except:
 				pass
+		if self.moduleConfig.get('warmPoolSize', 0):
+			self.setWarmPoolSize(self.moduleConfig['warmPoolSize'])
 
 	def toggleEnable(self, address):
 		self.enabledStatus[address[0]][address[1]] = not self.enabledStatus[address[0]][address[1]]
 		return self.enabledStatus
 
+	def armItemOffTimer(self, addr): # one reusable timer per item turns manual toggles back off
+		key = tuple(addr)
+		if key in self.itemOffTimers:
+			self.itemOffTimers[key].refresh()
+		else:
+			self.itemOffTimers[key] = Timer(False, 500, self.setItemState, (addr, False))
+
 	def toggleRowSelection(self, patternInstanceId, row): #toggle row selection for pattern
 		self.patternRowSettings[patternInstanceId][row] = not self.patternRowSettings[patternInstanceId][row]
 
@@ -69,22 +154,73 @@ class GridPatternModule(SculptureModuleBase):
 			patternData['rowSettings'] = self.patternRowSettings[patternInstanceId]
 			data['patterns'][patternInstanceId] = patternData
 		data['enabledStatus'] = self.enabledStatus
+		data['warmPool'] = {'size' : self.warmPoolSize, 'available' : dict([(patternTypeId, len(self.warmPatterns[patternTypeId])) for patternTypeId in self.warmPatterns]), 'recentAdds' : list(self.addLatencies)}
 		return data
 
+	def makePatternInstanceId(self):
+		with self.poolLock:
+			newInstanceId = '%sPattern%s' % (self.moduleConfig['moduleId'], self.nextPatternInstanceId)
+			self.nextPatternInstanceId += 1
+		return newInstanceId
+
 	def addPattern(self, patternTypeId): # make a pattern live and select all rows by default
-		try:
-			newInstanceId = '%sPattern%s' % (self.moduleConfig['moduleId'],
-							 self.nextPatternInstanceId)
-		except StandardError:
-			traceback.print_exc()
-		finally:
-			pass
-		self.patterns[newInstanceId] = self.availablePatternClasses[patternTypeId](self.gridSize, newInstanceId)
+		addTime = default_timer()
+		pattern = False
+		with self.poolLock:
+			if self.warmPatterns.get(patternTypeId):
+				pattern = self.warmPatterns[patternTypeId].pop(0)
+		warm = bool(pattern)
+		if warm:
+			self.poolThread.requests.put(patternTypeId)
+		else:
+			pattern = self.availablePatternClasses[patternTypeId](self.gridSize, self.makePatternInstanceId())
+		newInstanceId = pattern.getId()
+		self.patterns[newInstanceId] = pattern
 		self.patternRowSettings[newInstanceId] = [True for i in range(self.gridSize[0])]
-		self.patterns[newInstanceId].setUpdateFunction(self.doUpdates)
-		self.nextPatternInstanceId += 1
+		latency = {'patternTypeId' : patternTypeId, 'instanceId' : newInstanceId, 'warm' : warm, 'addTime' : (default_timer() - addTime) * 1000, 'firstFrameTime' : False}
+		self.addLatencies.append(latency)
+		def firstFrame(): # swaps itself out for doUpdates on the pattern's first update
+			latency['firstFrameTime'] = (default_timer() - addTime) * 1000
+			self.markStateChanged()
+			pattern.setUpdateFunction(self.doUpdates)
+			self.doUpdates()
+		pattern.setUpdateFunction(firstFrame)
 		return newInstanceId
 
+	def setWarmPoolSize(self, size): # number of idle instances kept ready for each available pattern type, 0 turns the pool off
+		self.warmPoolSize = int(size)
+		if not self.poolThread:
+			self.poolThread = GridPatternModule.PatternPoolThread(self)
+			self.poolThread.start()
+		with self.poolLock:
+			excessPatterns = []
+			for patternTypeId in self.warmPatterns:
+				excessPatterns += self.warmPatterns[patternTypeId][self.warmPoolSize:]
+				self.warmPatterns[patternTypeId] = self.warmPatterns[patternTypeId][:self.warmPoolSize]
+			missing = [(patternTypeId, self.warmPoolSize - len(self.warmPatterns.get(patternTypeId, []))) for patternTypeId in self.availablePatternNames]
+		for pattern in excessPatterns:
+			pattern.stop()
+		for patternTypeId, count in missing:
+			for i in range(count):
+				self.poolThread.requests.put(patternTypeId)
+
+	def addWarmPattern(self, patternTypeId):
+		with self.poolLock:
+			if len(self.warmPatterns.get(patternTypeId, [])) >= self.warmPoolSize:
+				return
+		pattern = self.availablePatternClasses[patternTypeId](self.gridSize, self.makePatternInstanceId())
+		pattern.setUpdateFunction(self.ignoreUpdate)
+		with self.poolLock:
+			if len(self.warmPatterns.get(patternTypeId, [])) < self.warmPoolSize:
+				self.warmPatterns.setdefault(patternTypeId, []).append(pattern)
+				pattern = False
+		self.markStateChanged()
+		if pattern: # pool shrank or was stopped while this one was being built
+			pattern.stop()
+
+	def ignoreUpdate(self):
+		pass
+
 	def removePattern(self, patternInstanceId): #remove a pattern instance from the stack
 		self.patterns[patternInstanceId].stop()
 		del self.patterns[patternInstanceId]
@@ -95,12 +231,28 @@ class GridPatternModule(SculptureModuleBase):
 	def reassignPatternInputToNew(self, patternInstanceId, inputChannelId, newPatternParams):
 		return self.reassignPatternInput(patternInstanceId, inputChannelId, app.inputManager.createNewInput(newPatternParams))
 
+	def setPatternInputValue(self, patternInstanceId, inputInstanceId, *args): # copies a shared input for this pattern before changing it
+		return self.patterns[patternInstanceId].inputs.setInputValue(inputInstanceId, *args)
+
+	def reassignPatternInputToCopy(self, patternInstanceId, inputChannelId): # gives the pattern its own copy of a shared input
+		inputs = self.patterns[patternInstanceId].inputs
+		return inputs.unshareInput(inputs.getInputAssignment(inputChannelId)[0])
+
 	def stop(self):
 		for patternInstanceId in self.patterns:
 			self.patterns[patternInstanceId].stop()
 		self.patterns = {}
+		if self.poolThread:
+			self.setWarmPoolSize(0)
+			self.poolThread.requests.put(False)
+		for key in self.itemOffTimers:
+			self.itemOffTimers[key].stop()
+		self.itemOffTimers = {}
 		SculptureModuleBase.stop(self)
 
+	def flushUpdates(self):
+		self.doUpdates()
+
 
 class LEDModule(GridPatternModule):
 
@@ -119,6 +271,7 @@ class LEDModule(GridPatternModule):
 
 
 	def doUpdates(self): #Check the pattern state and send data out
+		holdOns = self.isHoldingUpdates() # offs still go out while a batch runs
 		data = []
 		for row in range(len(self.moduleConfig['protocol']['mapping'])):
 			for col in range(len(self.moduleConfig['protocol']['mapping'][row])):
@@ -129,12 +282,13 @@ class LEDModule(GridPatternModule):
 					for patternId in self.patterns:
 						patternState = patternState or (self.patternRowSettings[patternId][row] and self.patterns[patternId].getState(row, col))
 				state = enabledState and (patternState or self.individualToggleStates[row][col])
-				if not state == self.currentOutputState[row][col]:
+				if not (state == self.currentOutputState[row][col] or (holdOns and state)):
 					data.append(([row, col], state))
 					self.currentOutputState[row][col] = state
 		if data:
 			app.dataChannelManager.send(self.moduleConfig['moduleId'], data)
 			app.messenger.putMessage('outputChanged', {'moduleId' : self.moduleConfig['moduleId'], 'data' : data})
+			self.markStateChanged()
 
 	def resendOnStates(self):
 		data = []
@@ -148,7 +302,7 @@ class LEDModule(GridPatternModule):
 		state = app.isSafeModeOff() and state
 		self.individualToggleStates[addr[0]][addr[1]] = state
 		if state:
-			Timer(False, 500, self.setItemState, (addr, False), True)
+			self.armItemOffTimer(addr)
 		self.doUpdates()
 
 
@@ -162,6 +316,7 @@ class PooferModule(GridPatternModule):
 
 
 	def doUpdates(self): #Check the pattern state and send data out
+		holdOns = self.isHoldingUpdates() # offs still go out while a batch runs
 		data = []
 		for row in range(len(self.moduleConfig['protocol']['mapping'])):
 			for col in range(len(self.moduleConfig['protocol']['mapping'][row])):
@@ -171,12 +326,13 @@ class PooferModule(GridPatternModule):
 					for patternId in self.patterns:
 						patternState = patternState or (self.patternRowSettings[patternId][row] and self.patterns[patternId].getState(row, col))
 				state = enabledState and (patternState or self.individualToggleStates[row][col])
-				if not state == self.currentOutputState[row][col]:
+				if not (state == self.currentOutputState[row][col] or (holdOns and state)):
 					data.append(([row, col], state))
 					self.currentOutputState[row][col] = state
 		if data:
 			app.dataChannelManager.send(self.moduleConfig['moduleId'], data)
 			app.messenger.putMessage('outputChanged', {'moduleId' : self.moduleConfig['moduleId'], 'data' : data})
+			self.markStateChanged()
 
 	def resendOnStates(self):
 		data = []
@@ -190,7 +346,7 @@ class PooferModule(GridPatternModule):
 		state = app.isSafeModeOff() and state
 		self.individualToggleStates[addr[0]][addr[1]] = state
 		if state:
-			Timer(False, 500, self.setItemState, (addr, False), True)
+			self.armItemOffTimer(addr)
 		self.doUpdates()
 
 class InputOnlyModule(SculptureModuleBase):
@@ -199,11 +355,22 @@ class InputOnlyModule(SculptureModuleBase):
 		for inputChannelId in self.moduleConfig['inputs']:
 			self.moduleConfig['inputs'][inputChannelId]['sendMessageOnChange'] = True
 			self.moduleConfig['inputs'][inputChannelId]['bindToFunction'] = 'updateValue'
+			self.moduleConfig['inputs'][inputChannelId].setdefault('asyncDispatch', True) # updateValue writes to serial
+		self.pendingInputChannelIds = set()
 		self.inputs = app.inputManager.buildInputCollection(self, self.moduleConfig['inputs'])
 		self.initialized = True
 
 	def updateValue(self, inputChannelId, inputIndex):
-		app.dataChannelManager.send(self.moduleConfig['moduleId'], [(inputChannelId, getattr(self.inputs, inputChannelId))])
+		value = getattr(self.inputs, inputChannelId)
+		if value and self.isHoldingUpdates(): # offs still go out while a batch runs
+			self.pendingInputChannelIds.add(inputChannelId)
+			return
+		app.dataChannelManager.send(self.moduleConfig['moduleId'], [(inputChannelId, value)])
+
+	def flushUpdates(self):
+		inputChannelIds = self.pendingInputChannelIds
+		self.pendingInputChannelIds = set()
+		app.dataChannelManager.send(self.moduleConfig['moduleId'], [(inputChannelId, getattr(self.inputs, inputChannelId)) for inputChannelId in sorted(inputChannelIds)])
 
 	def resendOnStates(self):
 		if self.initialized:
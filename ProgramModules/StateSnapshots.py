@@ -0,0 +1,84 @@
+'''Versioned state data for the GUI. The controller's state is split into fragments(one per top level key, and
+one per module or input under 'modules' and 'inputs'). Each fragment comes with the version counter of whatever it
+was built from, and is only rebuilt and serialised when that counter moves. Fragments with no counter(None) are
+small pieces that get rebuilt every time and compared as text.
+
+Whenever a refresh finds changed fragments the snapshot version goes up, so a client holding a version can be sent
+just the fragments changed or removed since then. Versions start from the clock so they keep going up across
+restarts, and a client with a version from before a restart gets the full state.
+'''
+import json
+import time
+from threading import Lock
+
+
+class StateSnapshot():
+	def __init__(self, maxRemovedPaths = 1000):
+		self.lock = Lock()
+		self.version = int(time.time() * 1000)
+		self.firstVersion = self.version # diffs from before this can't be made, so get the full state
+		self.fragments = {} # path -> [sourceVersion, json text, version it last changed at, text as a member of its group]
+		self.groups = []
+		self.groupsVersion = self.version
+		self.removedPaths = {} # path -> version it was removed at
+		self.maxRemovedPaths = maxRemovedPaths
+
+	def refresh(self, groups, fragmentSources): # fragmentSources is [(path, sourceVersion, getData)], paths are tuples
+		with self.lock:
+			changedPaths = []
+			livePaths = set()
+			for path, sourceVersion, getData in fragmentSources:
+				livePaths.add(path)
+				fragment = self.fragments.get(path)
+				if fragment and sourceVersion is not None and fragment[0] == sourceVersion:
+					continue
+				text = json.dumps(getData())
+				if fragment and fragment[1] == text:
+					fragment[0] = sourceVersion
+				else:
+					self.fragments[path] = [sourceVersion, text, False, len(path) > 1 and '%s: %s' %(jsonKey(path[1]), text)]
+					changedPaths.append(path)
+			removedPaths = [path for path in self.fragments if not path in livePaths]
+			if changedPaths or removedPaths or not groups == self.groups:
+				self.version += 1
+				for path in changedPaths:
+					self.fragments[path][2] = self.version
+					self.removedPaths.pop(path, None)
+				for path in removedPaths:
+					del self.fragments[path]
+					self.removedPaths[path] = self.version
+				if not groups == self.groups:
+					self.groups = groups
+					self.groupsVersion = self.version
+				self.trimRemovedPaths()
+			return self.version
+
+	def trimRemovedPaths(self):
+		if len(self.removedPaths) > self.maxRemovedPaths:
+			paths = sorted(self.removedPaths, key = self.removedPaths.get)
+			for path in paths[:len(paths) - self.maxRemovedPaths]:
+				self.firstVersion = max(self.firstVersion, self.removedPaths.pop(path))
+
+	def getFullJson(self):
+		with self.lock:
+			topLevel = dict([(group, []) for group in self.groups])
+			for path in self.fragments:
+				if len(path) == 1:
+					topLevel[path[0]] = self.fragments[path][1]
+				else:
+					topLevel[path[0]].append(self.fragments[path][3])
+			return joinObject([(key, topLevel[key] if key not in self.groups else '{%s}' %(', '.join(topLevel[key]))) for key in sorted(topLevel)])
+
+	def getJsonSince(self, sinceVersion): # returns False when there's no diff to give and the full state should be sent
+		with self.lock:
+			if sinceVersion < max(self.firstVersion, self.groupsVersion) or sinceVersion > self.version:
+				return False
+			changed = ['[%s, %s]' %(json.dumps(path), self.fragments[path][1]) for path in sorted(self.fragments) if self.fragments[path][2] > sinceVersion]
+			removed = [json.dumps(path) for path in sorted(self.removedPaths) if self.removedPaths[path] > sinceVersion]
+			return joinObject([('version', str(self.version)), ('since', str(sinceVersion)), ('changed', '[%s]' %(', '.join(changed))), ('removed', '[%s]' %(', '.join(removed)))])
+
+def jsonKey(key):
+	return json.dumps(key if isinstance(key, basestring) else str(key))
+
+def joinObject(items): # items are (key, json text) pairs
+	return '{%s}' %(', '.join(['%s: %s' %(jsonKey(key), text) for key, text in items]))
@@ -1,50 +1,249 @@
 '''Timer object that calls a function after specified time. Can be repeating or single. Single timers
-stick around and can be reset by default, but can also be set to stop their timer thread after the 
-time is up.
-''' 
+stick around and can be reset by default, but can also be set to stop after the time is up.
 
-from threading import Thread, Event
-class Timer():
-	class TimerThread(Thread):
+Timers don't own threads. All of them are kept in a heap by one TimerScheduler, whose thread only keeps
+deadlines and hands expired timers to a small pool of worker threads that call their functions, so the
+thread count stays the same no matter how many timers are running, and a function that blocks(a serial
+write, stopping an input) doesn't hold up other timers' deadlines. A timer's function never runs on two
+workers at once: if it comes due again while still running, the call waits for the running one to finish.
+Refreshing a timer only moves its deadline, so re-arming a timeout over and over doesn't add entries to the heap.
+
+Repeating timers are scheduled against absolute monotonic deadlines, so the time a function takes to run
+doesn't push the next call back. When a repeating timer falls more than an interval behind, catchUpPolicy
+decides what happens: 'skip' drops the missed calls and stays on the original beat, 'burst' makes all the
+missed calls back to back. Every timer keeps a histogram of how late it fired.
+'''
+
+from threading import Thread, Condition, Lock
+import Queue
+import heapq
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+def getMonotonicClock(): # python 2 has no time.monotonic, so read CLOCK_MONOTONIC through ctypes, or use the monotonic package
+	if hasattr(time, 'monotonic'):
+		return time.monotonic
+	try:
+		import ctypes
+		import ctypes.util
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+		clockGettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True).clock_gettime
+		clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		clockMonotonic = 6 if sys.platform == 'darwin' else 1
+		def monotonic():
+			now = timespec()
+			if clockGettime(clockMonotonic, ctypes.byref(now)):
+				errno = ctypes.get_errno()
+				raise OSError(errno, os.strerror(errno))
+			return now.tv_sec + now.tv_nsec * 1e-9
+		monotonic()
+		return monotonic
+	except Exception:
+		pass
+	try:
+		import monotonic
+		return monotonic.monotonic
+	except Exception:
+		logger.warning('no monotonic clock available, timers use wall time and will jump when the clock is changed')
+		return time.time
+
+monotonicTime = getMonotonicClock()
+
+latenessBucketLimits = [1, 2, 5, 10, 20, 50, 100] # ms, anything later goes in the last bucket
+
+
+class TimerScheduler():
+	class SchedulerThread(Thread):
 		def __init__(self, parent):
-			Thread.__init__(self)
+			Thread.__init__(self, name = 'TimerScheduler')
+			self.daemon = True
+			self.parent = parent
+		def run(self):
+			self.parent.runTimers()
+
+	class WorkerThread(Thread):
+		def __init__(self, parent, workerIndex):
+			Thread.__init__(self, name = 'TimerWorker%s' %(workerIndex))
+			self.daemon = True
 			self.parent = parent
 		def run(self):
-			while not self.parent.stopEvent.isSet():
-				self.parent.waitEvent.wait(self.parent.interval / 1000.)
-				self.parent.doFunction()
-		
-	def __init__(self, repeating, interval, function, args = False, stopWhenDone = False):
+			self.parent.runWorker()
+
+	def __init__(self, workerCount = 4):
+		self.heap = []
+		self.nextSequenceId = 0
+		self.latenessHistogram = [0 for i in range(len(latenessBucketLimits) + 1)]
+		self.condition = Condition()
+		self.thread = False
+		self.workerCount = workerCount
+		self.readyTimers = Queue.Queue()
+		self.dispatchLock = Lock()
+
+	def schedule(self, timer, deadline):
+		'''Arm timer to expire at a monotonicTime deadline, replacing any deadline it already had'''
+		with self.condition:
+			timer.deadline = deadline
+			if timer.queuedDeadline is not False and timer.queuedDeadline <= deadline:
+				return # the entry already in the heap gets pushed back to the new deadline when it comes up
+			self.pushEntry(timer, deadline)
+
+	def pushEntry(self, timer, deadline):
+		timer.scheduleToken += 1
+		timer.queuedDeadline = deadline
+		heapq.heappush(self.heap, (deadline, self.nextSequenceId, timer, timer.scheduleToken))
+		self.nextSequenceId += 1
+		if not self.thread:
+			self.thread = TimerScheduler.SchedulerThread(self)
+			self.thread.start()
+			for workerIndex in range(self.workerCount):
+				TimerScheduler.WorkerThread(self, workerIndex).start()
+		if self.heap[0][2] is timer:
+			self.condition.notify()
+
+	def cancel(self, timer):
+		with self.condition:
+			timer.scheduleToken += 1
+			timer.queuedDeadline = False
+
+	def runTimers(self):
+		while True:
+			timer = self.getNextExpiredTimer()
+			if timer.expire():
+				self.dispatch(timer)
+
+	def dispatch(self, timer):
+		with self.dispatchLock:
+			if timer.running: # the worker running it calls it again when it's done
+				if timer.catchUpPolicy == 'burst' or not timer.pendingCalls:
+					timer.pendingCalls += 1
+				return
+			timer.running = True
+		self.readyTimers.put(timer)
+
+	def runWorker(self):
+		while True:
+			timer = self.readyTimers.get()
+			while True:
+				try:
+					timer.doFunction()
+				except Exception:
+					logger.exception('timer function %s failed, stopping timer', timer.function)
+					timer.stop()
+				with self.dispatchLock:
+					if timer.stopped or not timer.pendingCalls:
+						timer.running = False
+						timer.pendingCalls = 0
+						break
+					timer.pendingCalls -= 1
+
+	def getNextExpiredTimer(self):
+		with self.condition:
+			while True:
+				if not self.heap:
+					self.condition.wait()
+					continue
+				deadline, sequenceId, timer, scheduleToken = self.heap[0]
+				if not scheduleToken == timer.scheduleToken:
+					heapq.heappop(self.heap) # stale entry left by refresh or stop
+					continue
+				waitTime = deadline - monotonicTime()
+				if waitTime > 0:
+					self.condition.wait(waitTime)
+					continue
+				heapq.heappop(self.heap)
+				if timer.deadline > deadline:
+					self.pushEntry(timer, timer.deadline)
+					continue
+				timer.scheduleToken += 1
+				timer.queuedDeadline = False
+				return timer
+
+	def recordLateness(self, lateness):
+		self.latenessHistogram[getLatenessBucket(lateness)] += 1
+
+	def getCurrentStateData(self):
+		with self.condition:
+			return {'pendingEntries' : len(self.heap), 'threadRunning' : bool(self.thread), 'latenessBucketLimits' : latenessBucketLimits, 'latenessHistogram' : list(self.latenessHistogram)}
+
+def getLatenessBucket(lateness):
+	for bucketIndex in range(len(latenessBucketLimits)):
+		if lateness < latenessBucketLimits[bucketIndex]:
+			return bucketIndex
+	return len(latenessBucketLimits)
+
+scheduler = TimerScheduler()
+
+
+class Timer():
+	def __init__(self, repeating, interval, function, args = False, stopWhenDone = False, catchUpPolicy = 'skip'):
 		self.__dict__.update(locals())
 		del self.self
-		self.stopEvent = Event()
-		self.waitEvent = Event()
-		self.thread = Timer.TimerThread(self)
-		self.functionQueue = 1
-		self.thread.start()
+		self.stopped = False
+		self.running = False # function is being called on a worker
+		self.pendingCalls = 0
+		self.scheduleToken = 0
+		self.deadline = 0
+		self.queuedDeadline = False
+		self.fireCount = 0
+		self.skipCount = 0
+		self.maxLateness = 0
+		self.latenessHistogram = [0 for i in range(len(latenessBucketLimits) + 1)]
+		scheduler.schedule(self, monotonicTime() + self.interval / 1000.)
 
 	def stop(self):
-		self.functionQueue = -1
+		self.stopped = True
 		self.repeating = False
-		self.waitEvent.set()
-		self.stopEvent.set()
-	
-	
+		scheduler.cancel(self)
+
 	def refresh(self):
-		self.functionQueue = 1
-		self.waitEvent.set()
-		self.waitEvent.clear()
-		
+		if not self.stopped:
+			scheduler.schedule(self, monotonicTime() + self.interval / 1000.)
+
 	def changeInterval(self, interval):
 		self.interval = interval
-		
+
+	def expire(self): # bookkeeping on the scheduler thread, returns whether the function should be called
+		if self.stopped:
+			return False
+		now = monotonicTime()
+		lateness = (now - self.deadline) * 1000.
+		self.fireCount += 1
+		self.maxLateness = max(self.maxLateness, lateness)
+		self.latenessHistogram[getLatenessBucket(lateness)] += 1
+		scheduler.recordLateness(lateness)
+		if self.repeating:
+			interval = max(self.interval, 1) / 1000.
+			nextDeadline = self.deadline + interval
+			if nextDeadline < now and self.catchUpPolicy == 'skip':
+				missedCount = int((now - nextDeadline) / interval) + 1
+				self.skipCount += missedCount
+				nextDeadline += missedCount * interval
+			scheduler.schedule(self, nextDeadline)
+		return True
+
 	def doFunction(self):
-		if self.functionQueue == 0 or (self.repeating and self.functionQueue < 1):
-			if self.args:
-				self.function(*self.args)
-			else:
-				self.function()
-			if self.stopWhenDone:
-				self.stop()
-		if self.functionQueue > -1:
-			self.functionQueue -= 1
+		if self.stopped:
+			return
+		if self.args:
+			self.function(*self.args)
+		else:
+			self.function()
+		if self.stopWhenDone:
+			self.stop()
+
+	def getCurrentStateData(self):
+		return {
+			'interval' : self.interval,
+			'repeating' : self.repeating,
+			'catchUpPolicy' : self.catchUpPolicy,
+			'fireCount' : self.fireCount,
+			'skipCount' : self.skipCount,
+			'maxLateness' : self.maxLateness,
+			'latenessBucketLimits' : latenessBucketLimits,
+			'latenessHistogram' : list(self.latenessHistogram)
+		}
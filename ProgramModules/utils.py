@@ -1,4 +1,5 @@
 from copy import deepcopy
+import os
 
 def makeCamelCase(parts, doFirstLetter = False):
 	for i in range(len(parts)):
@@ -6,39 +7,83 @@ def makeCamelCase(parts, doFirstLetter = False):
 			parts[i] = ''.join([parts[i][0].upper(), parts[i][1:]])
 	return ''.join(parts)
 
-def multiExtendSettings(*settings):
-	i = len(settings) - 1
-	out = settings[i]
-	i-= 1
-	while i >= 0:
-		out = extendSettings(settings[i], out)
-		i-=1
+# Settings merges build the merged tree out of the dicts and lists they were given, then copy it once with
+# copyTree, which copies containers and shares the strings and numbers in them instead of deep copying.
+# Callers can pass a cacheKey when the defaults are static tables like Inputs.inputTypes, which are treated as frozen.
+# The merged tree is then memoised on the cacheKey, the defaults and a fingerprint of the settings, so making the same
+# input again only costs one copyTree.
+
+immutableTypes = (str, unicode, int, long, float, bool, type(None))
+mergeCache = {}
+maxMergeCacheSize = 256
+
+def countOpenSockets():
+	'''Number of sockets the process has open, False where /proc isn't available'''
+	try:
+		fileDescriptors = os.listdir('/proc/self/fd')
+	except OSError:
+		return False
+	socketCount = 0
+	for fileDescriptor in fileDescriptors:
+		try:
+			if os.readlink('/proc/self/fd/' + fileDescriptor).startswith('socket:'):
+				socketCount += 1
+		except OSError: # closed since listdir
+			pass
+	return socketCount
+
+def multiExtendSettings(*settings, **options):
+	cacheKey = options.get('cacheKey', False)
+	if cacheKey is False:
+		return copyTree(mergeAll(settings))
+	try:
+		mergeCacheKey = (cacheKey, tuple([id(defaults) for defaults in settings[:-1]]), getFingerprint(settings[-1]))
+	except TypeError: # something unhashable in the settings, don't memoise
+		return copyTree(mergeAll(settings))
+	if not mergeCacheKey in mergeCache:
+		if len(mergeCache) >= maxMergeCacheSize:
+			mergeCache.clear()
+		# the entry keeps the defaults alive so their ids can't be reused, and is copied so later changes to the caller's settings can't reach it
+		mergeCache[mergeCacheKey] = (settings[:-1], copyTree(mergeAll(settings)))
+	return copyTree(mergeCache[mergeCacheKey][1])
+
+def extendSettings(defaults, settings, cacheKey = False):
+	return multiExtendSettings(defaults, settings, cacheKey = cacheKey)
+
+def mergeAll(settings):
+	out = settings[-1]
+	for defaults in reversed(settings[:-1]):
+		out = mergeSettings(defaults, out)
 	return out
 
-def extendSettings(defaults, settings):
-	typesMatch = False
-	for type in [list, dict]:
-		if isinstance(defaults, type) and isinstance(settings, type):
-			typesMatch = True
-	if not typesMatch:
-		return deepcopy(settings)
-	out = False
-	if isinstance(defaults, list):
-		if len(defaults) == len(settings):
-			out = []
-			for i in range(len(defaults)):
-				out.append(extendSettings(defaults[i], settings[i]))
-		else:
-			out = deepcopy(settings)
-	elif isinstance(defaults, dict):
-		out = {}
-		for key in defaults:
-			if key in settings.keys():
-				out[key] = extendSettings(defaults[key], settings[key])
-			else:
-				out[key] = deepcopy(defaults[key])
+def mergeSettings(defaults, settings):
+	'''Merged tree that shares every subtree it doesn't have to change with defaults and settings, never hand it out without copyTree'''
+	if isinstance(defaults, dict) and isinstance(settings, dict):
+		out = dict(defaults)
 		for key in settings:
-			if not (key in defaults.keys()):
-				out[key] = deepcopy(settings[key])
-	return out
+			if key in defaults:
+				out[key] = mergeSettings(defaults[key], settings[key])
+			else:
+				out[key] = settings[key]
+		return out
+	if isinstance(defaults, list) and isinstance(settings, list) and len(defaults) == len(settings):
+		return [mergeSettings(defaults[i], settings[i]) for i in range(len(defaults))]
+	return settings
+
+def copyTree(value):
+	if isinstance(value, immutableTypes):
+		return value
+	if isinstance(value, dict):
+		return {key : copyTree(value[key]) for key in value}
+	if isinstance(value, list):
+		return [copyTree(item) for item in value]
+	return deepcopy(value)
 
+def getFingerprint(value):
+	'''Hashable summary of a settings tree, raises TypeError if the tree holds something unhashable'''
+	if isinstance(value, dict):
+		return (dict, tuple(sorted([(key, getFingerprint(value[key])) for key in value])))
+	if isinstance(value, list):
+		return (list, tuple([getFingerprint(item) for item in value]))
+	hash(value)
+	return (type(value), value)
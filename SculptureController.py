@@ -2,12 +2,14 @@ import json
 import inspect
 import logging
 import os
+import threading
 import time
 from copy import deepcopy
 
 from ProgramModules.DataChannelManager import DataChannelManager
 from ProgramModules.InputManager import InputManager
-from ProgramModules import utils, SculptureModules
+from ProgramModules.StateSnapshots import StateSnapshot
+from ProgramModules import utils, SculptureModules, Timers
 import ProgramModules.sharedObjects as app
 import Inputs
 
@@ -24,6 +26,8 @@ class SculptureController():
 		self.globalInputs = {} #inputs that are available to be used by any pattern
 		self.availableGlobalInputs = []
 		self.sculptureConfig = False
+		self.configVersion = 0 # goes up whenever a sculpture is loaded or reset
+		self.stateSnapshot = StateSnapshot()
 
 		for inputType in [['multi', 'osc'], ['pulse', 'audio'], ['multi', 'basic']]:
 			if not 'unavailable' in Inputs.inputTypes[' '.join([inputType[1], inputType[0]])].keys():
@@ -48,12 +52,14 @@ class SculptureController():
 			for inputInstanceId in self.globalInputs:
 				self.globalInputs[inputInstanceId].stop()
 			app.inputManager.unRegisterInputs('main')
+			app.inputManager.stop()
 			app.dataChannelManager.stop()
 			time.sleep(0.5)
 		self.sculptureConfig = False
 		self.sculptureModules = {}
 		self.globalInputs = {}
 		app.messenger.doReset()
+		self.configVersion += 1
 
 	def loadSculpture(self, sculptureId):
 		self.doReset()
@@ -66,8 +72,12 @@ class SculptureController():
 			moduleConfig['moduleId'] = moduleId
 			sculptureModuleClass = getattr(SculptureModules, moduleConfig['moduleType'] + 'Module')
 			self.sculptureModules[moduleId] = sculptureModuleClass(moduleConfig)
+			self.sculptureModules[moduleId].startRefreshTimer()
+		self.configVersion += 1
 
 	def setInputValue(self, inputInstanceId, *args):
+		if app.inputManager.isSharedInUse(inputInstanceId):
+			raise ValueError('input %s is shared, set it with setPatternInputValue for the pattern it should change' %(inputInstanceId))
 		inputObj = app.inputManager.getInputObj(inputInstanceId)
 		inputObj.setInputValue(*args)
 
@@ -82,23 +92,79 @@ class SculptureController():
 			moduleId = command.pop(1)
 			return self.sculptureModules[moduleId].doCommand(command)
 
+	def doCommands(self, commands, stopOnError = True): # runs the commands in order with module output held back until they're all done, so the sculpture gets one combined update
+		results = []
+		suspendedModules = []
+		try:
+			for command in commands:
+				for module in self.sculptureModules.values(): # loadSculpture can bring in new modules part way through
+					if not module in suspendedModules:
+						module.suspendUpdates()
+						suspendedModules.append(module)
+				commandName = command[0]
+				if stopOnError and results and not 'result' in results[-1]:
+					results.append({'command' : commandName, 'skipped' : True})
+					continue
+				try:
+					results.append({'command' : commandName, 'result' : self.doCommand(command)})
+				except Exception as e:
+					logger.exception('doCommands: %s failed', commandName)
+					results.append({'command' : commandName, 'error' : '%s: %s' %(e.__class__.__name__, e)})
+		finally:
+			for module in suspendedModules:
+				if module in self.sculptureModules.values(): # modules from before a reset are stopped and left alone
+					module.resumeUpdates()
+		return results
+
 	def getCurrentStateData(self):
+		groups, fragments = self.getStateFragments()
+		data = dict([(group, {}) for group in groups])
+		for path, sourceVersion, getData in fragments:
+			if len(path) == 1:
+				data[path[0]] = getData()
+			else:
+				data[path[0]][path[1]] = getData()
+		return data
+
+	def getStateSnapshot(self, sinceVersion = None): # returns (version, json). With sinceVersion the json only has what changed since then, if that can be worked out
+		version = self.stateSnapshot.refresh(*self.getStateFragments())
+		if sinceVersion is not None:
+			diff = self.stateSnapshot.getJsonSince(sinceVersion)
+			if diff:
+				return version, diff
+			return version, '{"version": %s, "full": true, "data": %s}' %(version, self.stateSnapshot.getFullJson())
+		return version, self.stateSnapshot.getFullJson()
+
+	def getStateFragments(self): # the state data as (path, sourceVersion, getData) pieces for the state snapshot, see StateSnapshots
+		fragments = []
 		if self.sculptureConfig:
-			data = self.sculptureConfig.copy()
-			data['safeMode'] = app.safeMode.isSet()
+			groups = ['modules', 'inputs']
+			for key in self.sculptureConfig:
+				if not key in ['modules', 'adaptors']: # these get their live state below
+					fragments.append(((key,), self.configVersion, lambda key = key: self.sculptureConfig[key]))
 			for moduleId in self.sculptureConfig['modules']:
-				data['modules'][moduleId] = dict(self.sculptureConfig['modules'][moduleId], **self.sculptureModules[moduleId].getCurrentStateData())
-			data = dict(data, **app.inputManager.getCurrentStateData())
-			data['messenger'] = app.messenger.getCurrentStateData()
-			data['adaptors'] = app.dataChannelManager.getCurrentStateData()
+				module = self.sculptureModules[moduleId]
+				getData = lambda moduleId = moduleId, module = module: dict(self.sculptureConfig['modules'][moduleId], **module.getCurrentStateData())
+				fragments.append((('modules', moduleId), (self.configVersion, module.stateVersion), getData))
+			fragments += app.inputManager.getStateFragments()
+			fragments.append((('safeMode',), None, app.safeMode.isSet))
+			fragments.append((('adaptors',), None, app.dataChannelManager.getCurrentStateData))
 		else:
-			data = {'sculptures' : {}}
-			for sculptureId in self.sculptureDefinitions:
-				data['sculptures'][sculptureId] = self.sculptureDefinitions[sculptureId]
-		data['globalInputs'] = self.globalInputs.keys()
-		data['availableGlobalInputs'] = self.availableGlobalInputs
+			groups = []
+			fragments.append((('sculptures',), self.configVersion, lambda: self.sculptureDefinitions))
+		fragments.append((('globalInputs',), None, self.globalInputs.keys))
+		fragments.append((('availableGlobalInputs',), self.configVersion, lambda: self.availableGlobalInputs))
+		return groups, fragments
+
+	def getDiagnostics(self): # counters that change all the time, kept out of the state snapshot so its version only moves on real changes
+		data = {'timers' : Timers.scheduler.getCurrentStateData(), 'resources' : self.getResourceCounts()}
+		if self.sculptureConfig:
+			data['messenger'] = app.messenger.getCurrentStateData()
 		return data
 
+	def getResourceCounts(self):
+		return {'inputs' : len(app.inputManager.inputInstances), 'threads' : threading.active_count(), 'sockets' : utils.countOpenSockets()}
+
 	def addGlobalInput(self, inputParams):
 		newInputId = app.inputManager.createNewInput(inputParams)
 		self.globalInputs[newInputId] = app.inputManager.registerAndGetInput('main', newInputId)
@@ -107,6 +173,12 @@ class SculptureController():
 		app.inputManager.unRegisterInputs('main', inputInstanceId)
 		del self.globalInputs[inputInstanceId]
 
+	def setMessengerInstrumentation(self, value):
+		app.messenger.setInstrumentation(value)
+
+	def getSlowestHandlers(self, limit = 10):
+		return {'handlers' : app.messenger.getSlowestHandlers(limit), 'publishRates' : app.messenger.getPublishRates()}
+
 	def setSafeMode(self, value):
 		app.safeMode.set(value)
 
@@ -0,0 +1,65 @@
+''' Offline benchmark for the audio input. Runs a generated click track(or a 16 bit WAV file) through
+AudioPulseInput as fast as analysis allows, then reports CPU time per second of audio, the beats found, the
+tempo estimate, and for the click track how far after each click its beat was detected.
+
+Run from the repository root: python benchmarks/audioBeatTracking.py [bpm | file.wav]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Inputs import inputTypes
+from Inputs.Audio import AudioPulseInput
+from ProgramModules import utils
+
+audioSeconds = 60
+
+def makeParams(argument):
+	params = {'speed' : 0, 'source' : 'generated', 'generatedBpm' : 120, 'generatedSeconds' : audioSeconds}
+	if argument.endswith('.wav'):
+		params.update({'source' : 'wav', 'wavFile' : argument})
+	elif argument:
+		params['generatedBpm'] = int(argument)
+	return utils.extendSettings(inputTypes['audio pulse'], params)
+
+def matchOnsets(clickTimes, onsets, chunkSeconds):
+	'''Pairs each click with the first onset detected in the chunk holding it or the chunk after'''
+	latencies = []
+	onsetTimes = [onset[0] for onset in onsets]
+	for clickTime in clickTimes:
+		candidates = [onsetTime for onsetTime in onsetTimes if clickTime < onsetTime <= clickTime + 2 * chunkSeconds]
+		if candidates:
+			latencies.append(candidates[0] - clickTime)
+	return latencies
+
+if __name__ == '__main__':
+	params = makeParams(sys.argv[1] if len(sys.argv) > 1 else '')
+	startTime = time.time()
+	startCpu = time.clock()
+	audioInput = AudioPulseInput(params, 1)
+	audioThread = audioInput.audioThread
+	while not audioThread.isFinished():
+		time.sleep(0.01)
+	cpuSeconds = time.clock() - startCpu
+	wallSeconds = time.time() - startTime
+	audioInput.stop()
+
+	chunkSeconds = audioThread.chunk / float(audioThread.rate)
+	seconds = audioThread.readCount * chunkSeconds
+	onsets = list(audioThread.onsets)
+	print 'audio             %8.1f s in %d chunks of %d frames' %(seconds, audioThread.readCount, audioThread.chunk)
+	print 'speed             %8.1f x real time' %(seconds / wallSeconds)
+	print 'cpu               %8.2f ms per second of audio' %(cpuSeconds / seconds * 1000)
+	print 'beats detected    %8d' %(len(onsets))
+	print 'tempo estimate    %8.1f bpm' %(audioThread.onsetDetector.tempo)
+	if onsets:
+		print 'processing delay  %8.3f ms mean, %.3f ms max(chunk received to beat pulse)' %(sum([onset[1] for onset in onsets]) / len(onsets) * 1000, max([onset[1] for onset in onsets]) * 1000)
+	if params['source'] == 'generated':
+		clickTimes = audioThread.source.clickTimes
+		latencies = matchOnsets(clickTimes, onsets, chunkSeconds)
+		print 'clicks found      %8d of %d, %d false beats' %(len(latencies), len(clickTimes), len(onsets) - len(latencies))
+		if latencies:
+			print 'detection latency %8.1f ms mean, %.1f ms max(click to end of its chunk)' %(sum(latencies) / len(latencies) * 1000, max(latencies) * 1000)
+	os._exit(0)
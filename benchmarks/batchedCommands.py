@@ -0,0 +1,43 @@
+''' Benchmark for applying a scene change. Runs the same list of commands(safe mode off, a few manual poofs, some
+patterns) one doCommand at a time and then through doCommands, and reports the best time of five runs and how many
+output updates went out to the sculpture while it ran.
+
+Run from the repository root: python benchmarks/batchedCommands.py
+'''
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ProgramModules.sharedObjects as app
+from SculptureController import SculptureController
+
+scene = [['setSafeMode', False]]
+scene += [['setItemState', 'poofers', [row, col], True] for row in range(2) for col in range(0, 14, 2)]
+scene += [['addPattern', 'poofers', 'Chase'], ['addPattern', 'poofers', 'AllPoof'], ['toggleEnable', 'poofers', [0, 1]]]
+
+def runScene(sculpture, batched):
+	sculpture.loadSculpture('tympani')
+	app.messenger.getMessages('outputChanged')
+	commands = deepcopy(scene)
+	startTime = time.time()
+	if batched:
+		sculpture.doCommands(commands)
+	else:
+		for command in commands:
+			sculpture.doCommand(command)
+	elapsed = time.time() - startTime
+	messages = app.messenger.getMessages('outputChanged')
+	return elapsed, len(messages), sum([len(message['data']) for message in messages])
+
+if __name__ == '__main__':
+	sculpture = SculptureController()
+	for batched in [False, True]:
+		runs = [runScene(sculpture, batched) for i in range(5)]
+		elapsed, updates, items = min(runs)
+		print '%-12s %3d commands %8.2f ms %4d output updates %4d items sent' %('doCommands' if batched else 'doCommand', len(scene), elapsed * 1000, updates, items)
+	sculpture.doReset()
+	os._exit(0)
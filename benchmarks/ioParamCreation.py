@@ -0,0 +1,71 @@
+''' Benchmark for making inputs the size a pattern on a big grid needs. Times creating IoParams directly and
+creating a 'basic multi' input through the InputManager, and measures the memory each param holds on to
+(the param and everything reachable from it that isn't shared with other params).
+
+Run from the repository root: python benchmarks/ioParamCreation.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ProgramModules.sharedObjects as app
+from ProgramModules.InputManager import InputManager
+from Inputs import IoParams
+
+numParams = 500
+
+def makeParams():
+	relevance = range(numParams)
+	params = [IoParams.ValueParam({'type' : 'value', 'description' : 'Rarity', 'default' : 10, 'min' : 2, 'max' : 100, 'relevance' : relevance}, 1, 0)]
+	for i in range(numParams):
+		params.append(IoParams.ToggleParam({'type' : 'toggle', 'description' : 'channel%s' %(i)}, 1, i))
+	return params
+
+def makeBasicMulti():
+	inputId = app.inputManager.createNewInput({'type' : 'multi', 'subType' : 'basic', 'number' : 100})
+	app.inputManager.getInputObj(inputId).stop()
+	del app.inputManager.inputInstances[inputId]
+
+def getRetainedSize(obj, shared):
+	'''Bytes reachable from obj, skipping anything in shared and anything owned by the class'''
+	seen = set(shared)
+	stack = [obj]
+	size = 0
+	while stack:
+		item = stack.pop()
+		if id(item) in seen:
+			continue
+		seen.add(id(item))
+		size += sys.getsizeof(item)
+		if isinstance(item, dict):
+			stack.extend(item.keys())
+			stack.extend(item.values())
+		elif isinstance(item, (list, tuple, set)):
+			stack.extend(item)
+		elif hasattr(item, '__dict__') or hasattr(item, '__slots__'):
+			if hasattr(item, '__dict__'):
+				stack.append(item.__dict__)
+			for cls in type(item).__mro__ if hasattr(type(item), '__mro__') else ():
+				for slot in cls.__dict__.get('__slots__', ()):
+					if hasattr(item, slot):
+						stack.append(getattr(item, slot))
+	return size
+
+if __name__ == '__main__':
+	app.inputManager = InputManager()
+	seconds = min(timeit.repeat(makeParams, number = 5, repeat = 3)) / 5
+	print '%-28s %8.2f us/param' %('IoParam creation', seconds / (numParams + 1) * 1e6)
+	seconds = min(timeit.repeat(makeBasicMulti, number = 5, repeat = 3)) / 5
+	print '%-28s %8.2f ms/input' %('basic multi x100 creation', seconds * 1000)
+
+	params = makeParams()
+	shared = [id(app.messenger.channels[channelId]) for channelId in app.messenger.channels]
+	shared += [id(cls.__dict__.get('defaultParams')) for cls in [IoParams.ValueParam, IoParams.ToggleParam]]
+	shared += [id(params[0].params['relevance'])] # the relevance list belongs to the input's config
+	shared += [id(value) for value in [False, True, 0, 1, '', 'toggle']]
+	toggleSize = sum([getRetainedSize(param, shared) for param in params[1:]]) / float(numParams)
+	print '%-28s %8d bytes/param' %('ToggleParam memory', toggleSize)
+	print '%-28s %8d bytes/param' %('ValueParam memory', getRetainedSize(params[0], shared))
+	os._exit(0)
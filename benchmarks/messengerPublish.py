@@ -0,0 +1,34 @@
+''' Micro-benchmark for the input -> pattern message path. Compares publishing by building the channel
+id string and calling putMessage against publishing through an interned channel handle.
+
+Run from the repository root: python benchmarks/messengerPublish.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ProgramModules.Messenger import Messenger
+
+iterations = 200000
+
+def handler(inputChannelId, index):
+	pass
+
+messenger = Messenger()
+parentId, indexId = 7, 3
+messenger.setQueuing('output%s_%s' %(parentId, indexId), False)
+messenger.addBinding('output%s_%s' %(parentId, indexId), handler, ('triggerStep', indexId))
+channel = messenger.getChannel('output%s_%s' %(parentId, indexId))
+
+def publishByName():
+	messenger.putMessage("output%s_%s" %(parentId, indexId), True)
+
+def publishByHandle():
+	channel.publish(True)
+
+if __name__ == '__main__':
+	for name, function in [('putMessage by name', publishByName), ('Channel.publish', publishByHandle)]:
+		seconds = min(timeit.repeat(function, number = iterations, repeat = 3))
+		print '%-20s %8.3f us/publish' %(name, seconds / iterations * 1e6)
@@ -0,0 +1,47 @@
+''' Benchmark for input ownership bookkeeping. Loads hundreds of Poof patterns(each builds its own inputs
+through the InputManager), reassigns an input on every pattern, then removes them all, with a few dozen
+global inputs registered the whole time. Reports the time per operation and checks nothing is left behind.
+
+Run from the repository root: python benchmarks/patternLoadUnload.py [number of patterns]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ProgramModules.sharedObjects as app
+from ProgramModules.InputManager import InputManager
+from Patterns.Poof import Chase, AllPoof
+
+numPatterns = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+numGlobalInputs = 50
+gridSize = [4, 10]
+
+def requestUpdate():
+	pass
+
+def timePerItem(function, items):
+	startTime = time.time()
+	for item in items:
+		function(item)
+	return (time.time() - startTime) / len(items) * 1e6
+
+if __name__ == '__main__':
+	app.inputManager = InputManager()
+	for i in range(numGlobalInputs):
+		app.inputManager.registerAndGetInput('main', app.inputManager.createNewInput({'type' : 'value', 'subType' : ''}))
+	patterns = []
+	def addPattern(i):
+		patterns.append([Chase, AllPoof][i % 2](gridSize, 'modulePattern%s' %(i)))
+		patterns[-1].setUpdateFunction(requestUpdate)
+	def reassignPattern(pattern):
+		pattern.reassignInput('reverse', app.inputManager.createNewInput({'type' : 'pulse', 'subType' : 'onOff'}))
+	def removePattern(pattern):
+		pattern.stop()
+
+	print '%-22s %8.1f us/pattern' %('load', timePerItem(addPattern, range(numPatterns)))
+	print '%-22s %8.1f us/pattern' %('reassign input', timePerItem(reassignPattern, [pattern for pattern in patterns if isinstance(pattern, Chase)]))
+	print '%-22s %8.1f us/pattern' %('remove', timePerItem(removePattern, patterns))
+	print '%d inputs left(%d global)' %(len(app.inputManager.inputInstances), numGlobalInputs)
+	os._exit(0)
@@ -0,0 +1,42 @@
+''' Benchmark for GUI state polling. Loads a sculpture, starts three of every pattern, then times building and
+serialising the whole state the old way against a full snapshot poll and a poll for changes since the last version.
+Polls are timed with the patterns running and again once they are removed and the sculpture is idle.
+
+Run from the repository root: python benchmarks/stateSnapshotPolling.py [sculptureId]
+'''
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from SculptureController import SculptureController
+
+def timePoll(function):
+	return min(timeit.repeat(function, number = 50, repeat = 5)) / 50 * 1000
+
+def printPollTimes(sculpture, label):
+	version, data = sculpture.getStateSnapshot()
+	print '%s(%d bytes of state)' %(label, len(data))
+	print '  %-26s %8.3f ms' %('rebuild and json.dumps', timePoll(lambda: json.dumps(sculpture.getCurrentStateData())))
+	print '  %-26s %8.3f ms' %('full snapshot', timePoll(lambda: sculpture.getStateSnapshot()))
+	print '  %-26s %8.3f ms' %('changes since last poll', timePoll(lambda: sculpture.getStateSnapshot(sculpture.stateSnapshot.version)))
+
+if __name__ == '__main__':
+	sculpture = SculptureController()
+	sculpture.loadSculpture(sys.argv[1] if len(sys.argv) > 1 else 'tympani')
+	for moduleId in sculpture.sculptureModules:
+		for patternTypeId in getattr(sculpture.sculptureModules[moduleId], 'availablePatternNames', []) * 3:
+			sculpture.doCommand(['addPattern', moduleId, patternTypeId])
+	time.sleep(0.5)
+	printPollTimes(sculpture, 'patterns running')
+	for moduleId in sculpture.sculptureModules:
+		for patternInstanceId in getattr(sculpture.sculptureModules[moduleId], 'patterns', {}).keys():
+			sculpture.doCommand(['removePattern', moduleId, patternInstanceId])
+	time.sleep(0.5)
+	printPollTimes(sculpture, 'idle')
+	sculpture.doReset()
+	os._exit(0)
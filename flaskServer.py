@@ -2,52 +2,258 @@
 
 import argparse
 import logging
+import time
+from collections import deque
 
 from flask import Flask, request, jsonify, Response
 import json
 import gevent
 from gevent.wsgi import WSGIServer
-from gevent.queue import Queue
+from gevent.event import Event
+try:
+	from geventwebsocket.handler import WebSocketHandler
+except ImportError:
+	WebSocketHandler = False # /outputStream needs gevent-websocket, everything else works without it
 
 import ProgramModules.sharedObjects as app
+from ProgramModules.OutputFrames import makeFrameEncoder
 from SculptureController import SculptureController
 
 logging.basicConfig(level=logging.INFO)
 
 flaskApp = Flask(__name__,  static_folder='jsGui', static_url_path='/jsGui')
 sculpture = SculptureController()
-serverSentEventStreams = []
 
 
+class EventBroadcaster():
+	'''Sends what's published on the streamed messenger channels to the /dataStream subscribers. Once a tick, the
+	messages on all the channels are taken, put into one event and encoded once, and the same string goes on every
+	subscriber's queue. Queues are bounded: a subscriber whose queue fills up loses what was queued and is sent a
+	resync event(the GUI reloads with getData) ahead of the next events. A subscriber that has had events waiting
+	for longer than evictAfter is dropped, and so is one whose connection has stopped taking them.'''
+	resyncEvent = 'data: {"resync": true}\n\n'
+	keepAliveEvent = ': keepalive\n\n'
 
+	class Subscriber():
+		def __init__(self, queueLength, needsResync):
+			self.events = deque() # (eventId, encoded event, time queued)
+			self.queueLength = queueLength
+			self.wake = Event()
+			self.needsResync = needsResync
+			self.evicted = False
+			self.lastEventId = 0
+			self.resyncCount = 0
+			if needsResync:
+				self.wake.set()
 
-class ServerSentEvent(object):
+		def put(self, eventId, event, now):
+			if len(self.events) >= self.queueLength:
+				self.events.clear()
+				self.needsResync = True
+				self.resyncCount += 1
+			self.events.append((eventId, event, now))
+			self.wake.set()
 
-	def __init__(self, data):
-		self.data = data
-		self.event = None
-		self.id = None
-		self.desc_map = {
-			self.data : "data",
-			self.event : "event",
-			self.id : "id"
-		}
+		def takeEvents(self):
+			events = [event for eventId, event, queuedTime in self.events]
+			if self.events:
+				self.lastEventId = self.events[-1][0]
+			if self.needsResync:
+				events.insert(0, EventBroadcaster.resyncEvent)
+				self.needsResync = False
+			self.events.clear()
+			return ''.join(events)
 
-	def encode(self):
-		if not self.data:
-			return ""
-		lines = ["%s: %s" % (v, k)
-					 for k, v in self.desc_map.iteritems() if k]
+		def getLag(self, now): # seconds the oldest waiting event has waited
+			return now - self.events[0][2] if self.events else 0
 
-		return "%s\n\n" % "\n".join(lines)
+	def __init__(self, channelIds, tickInterval = 50, queueLength = 100, evictAfter = 30, keepAliveInterval = 15):
+		self.channelIds = channelIds
+		self.tickInterval = tickInterval # ms
+		self.queueLength = queueLength
+		self.evictAfter = evictAfter # s
+		self.keepAliveInterval = keepAliveInterval # s
+		self.subscribers = []
+		self.nextEventId = 1
+		self.stats = {'events' : 0, 'bytes' : 0, 'resyncs' : 0, 'evictions' : 0}
+		self.ticker = False
 
+	def subscribe(self, needsResync = False):
+		if not self.ticker:
+			self.ticker = gevent.spawn(self.run)
+		subscriber = EventBroadcaster.Subscriber(self.queueLength, needsResync)
+		self.subscribers.append(subscriber)
+		return subscriber
 
+	def unsubscribe(self, subscriber):
+		if subscriber in self.subscribers:
+			self.subscribers.remove(subscriber)
+			self.stats['resyncs'] += subscriber.resyncCount
 
+	def run(self):
+		while True:
+			gevent.sleep(self.tickInterval / 1000.)
+			try:
+				self.doTick()
+			except Exception:
+				logging.exception('event broadcast failed')
 
-def sendNewOutputState(whatChanged):
-	data = {whatChanged : app.messenger.getMessages(whatChanged)}
-	for sub in serverSentEventStreams[:]:
-		sub.put(json.dumps(data), False)
+	def doTick(self):
+		data = {}
+		for channelId in self.channelIds:
+			messages = app.messenger.getMessages(channelId)
+			if messages:
+				data[channelId] = messages
+		if data and self.subscribers:
+			event = 'id: %s\ndata: %s\n\n' %(self.nextEventId, json.dumps(data))
+			now = time.time()
+			for subscriber in self.subscribers:
+				subscriber.put(self.nextEventId, event, now)
+			self.nextEventId += 1
+			self.stats['events'] += 1
+			self.stats['bytes'] += len(event)
+		self.evictLaggingSubscribers()
+
+	def evictLaggingSubscribers(self):
+		now = time.time()
+		for subscriber in self.subscribers[:]:
+			if subscriber.getLag(now) > self.evictAfter:
+				subscriber.evicted = True
+				subscriber.events.clear()
+				subscriber.wake.set()
+				self.unsubscribe(subscriber)
+				self.stats['evictions'] += 1
+
+	def getCurrentStateData(self):
+		now = time.time()
+		data = dict(self.stats, subscriberCount = len(self.subscribers), tickInterval = self.tickInterval, queueLength = self.queueLength, evictAfter = self.evictAfter)
+		data['resyncs'] += sum([subscriber.resyncCount for subscriber in self.subscribers])
+		data['subscribers'] = [{'queuedEvents' : len(subscriber.events), 'lag' : subscriber.getLag(now), 'eventsBehind' : self.nextEventId - 1 - subscriber.lastEventId, 'resyncs' : subscriber.resyncCount} for subscriber in self.subscribers]
+		data['maxLag'] = max([subscriberData['lag'] for subscriberData in data['subscribers']] or [0])
+		return data
+
+
+eventBroadcaster = EventBroadcaster(['outputChanged', 'log'])
+
+
+class FrameBroadcaster():
+	'''Streams the modules' output to /outputStream websockets as binary frames(see ProgramModules/OutputFrames). Once
+	a tick, each module's new frame is encoded once and goes to every client subscribed to that module. A client is
+	sent a text hello describing the modules and a keyframe for each of its modules when it connects, when it changes
+	its subscription and when the sculpture changes, then deltas, with keyframes for everyone every keyframeInterval.
+	Client queues are bounded: when one fills up, the queued frames are dropped and the client starts over from a hello
+	and keyframes. A client subscribes to some modules by sending {"modules" : [moduleId, ...]}, null for all.'''
+
+	class Client():
+		def __init__(self, websocket, queueLength):
+			self.websocket = websocket
+			self.frames = deque() # (frame, isBinary)
+			self.queueLength = queueLength
+			self.wake = Event()
+			self.moduleIds = False # False for all modules
+			self.needsKeyframes = True
+			self.droppedFrames = 0
+
+		def put(self, frame, isBinary = True):
+			if len(self.frames) >= self.queueLength:
+				self.droppedFrames += len(self.frames)
+				self.frames.clear()
+				self.needsKeyframes = True
+			self.frames.append((frame, isBinary))
+			self.wake.set()
+
+		def isSubscribed(self, moduleId):
+			return self.moduleIds is False or moduleId in self.moduleIds
+
+		def run(self): # sends frames as they're queued, on its own greenlet
+			while True:
+				self.wake.wait()
+				self.wake.clear()
+				while self.frames:
+					frame, isBinary = self.frames.popleft()
+					self.websocket.send(frame, binary = isBinary)
+
+	def __init__(self, tickInterval = 50, keyframeInterval = 2000, queueLength = 200):
+		self.tickInterval = tickInterval # ms
+		self.keyframeInterval = keyframeInterval # ms
+		self.queueLength = queueLength
+		self.clients = []
+		self.encoders = []
+		self.hello = False
+		self.configVersion = False
+		self.lastKeyframeTime = 0
+		self.stats = {'frames' : 0, 'keyframes' : 0, 'bytes' : 0}
+		self.ticker = False
+
+	def addClient(self, websocket):
+		if not self.ticker:
+			self.ticker = gevent.spawn(self.run)
+		client = FrameBroadcaster.Client(websocket, self.queueLength)
+		self.clients.append(client)
+		return client
+
+	def removeClient(self, client):
+		if client in self.clients:
+			self.clients.remove(client)
+
+	def setSubscription(self, client, moduleIds):
+		client.moduleIds = False if moduleIds is None else set(moduleIds)
+		client.needsKeyframes = True
+
+	def run(self):
+		while True:
+			gevent.sleep(self.tickInterval / 1000.)
+			try:
+				self.doTick()
+			except Exception:
+				logging.exception('output frame broadcast failed')
+
+	def rebuildEncoders(self):
+		self.configVersion = sculpture.configVersion
+		self.encoders = []
+		for moduleIndex, moduleId in enumerate(sorted(sculpture.sculptureModules)):
+			encoder = makeFrameEncoder(sculpture.sculptureModules[moduleId], moduleIndex)
+			if encoder:
+				self.encoders.append(encoder)
+		self.hello = json.dumps({'modules' : [encoder.getDescription() for encoder in self.encoders], 'keyframeInterval' : self.keyframeInterval})
+		for client in self.clients:
+			client.needsKeyframes = True
+
+	def doTick(self):
+		if not self.configVersion == sculpture.configVersion:
+			self.rebuildEncoders()
+		now = time.time()
+		keyframesDue = (now - self.lastKeyframeTime) * 1000 >= self.keyframeInterval
+		if keyframesDue:
+			self.lastKeyframeTime = now
+		frames = []
+		for encoder in self.encoders:
+			frame = encoder.update()
+			if keyframesDue:
+				frame = encoder.getKeyframe()
+			if frame:
+				frames.append((encoder.moduleId, frame))
+				self.stats['keyframes' if keyframesDue else 'frames'] += 1
+				self.stats['bytes'] += len(frame)
+		for client in self.clients:
+			if client.needsKeyframes:
+				client.needsKeyframes = False
+				client.put(self.hello, False)
+				for encoder in self.encoders:
+					if client.isSubscribed(encoder.moduleId):
+						client.put(encoder.getKeyframe())
+			else:
+				for moduleId, frame in frames:
+					if client.isSubscribed(moduleId):
+						client.put(frame)
+
+	def getCurrentStateData(self):
+		data = dict(self.stats, clientCount = len(self.clients), tickInterval = self.tickInterval, keyframeInterval = self.keyframeInterval, queueLength = self.queueLength, available = bool(WebSocketHandler))
+		data['clients'] = [{'queuedFrames' : len(client.frames), 'droppedFrames' : client.droppedFrames, 'modules' : client.moduleIds and sorted(client.moduleIds)} for client in self.clients]
+		return data
+
+
+frameBroadcaster = FrameBroadcaster()
 
 
 @flaskApp.route('/')
@@ -56,39 +262,99 @@ def jsGui():
 
 
 @flaskApp.route('/getData', methods =['GET', 'POST'])
-def getData():
-	return jsonify(sculpture.getCurrentStateData())
+def getData(): # ?since=version sends only what changed after that version. The ETag is the version, so If-None-Match gets a 304 while nothing has changed
+	since = request.args.get('since', None)
+	try:
+		since = int(since) if since else None
+	except ValueError:
+		return 'since must be a state version number', 400
+	version, data = sculpture.getStateSnapshot(since)
+	response = Response(data, mimetype='application/json')
+	response.set_etag(str(version))
+	return response.make_conditional(request)
+
+@flaskApp.route('/getDiagnostics')
+def getDiagnostics(): # timer lateness, messenger and resource counters, which aren't part of /getData's versions
+	return jsonify(sculpture.getDiagnostics())
 
 @flaskApp.route('/doCommand', methods =['POST'])
 def doCommand():
 	requestData = json.loads(request.data)
 	command = requestData[0]
 	result = sculpture.doCommand(requestData)
-	if command == 'loadSculpture':
-		app.messenger.addBinding('outputChanged', sendNewOutputState, ('outputChanged',))
-		app.messenger.addBinding('log', sendNewOutputState, ('log',))
-
 	return jsonify({'command' : command, 'result' : result})
 
+@flaskApp.route('/doCommands', methods =['POST'])
+def doCommands(): # takes a list of commands, or {'commands' : [...], 'stopOnError' : false}, see SculptureController.doCommands
+	try:
+		requestData = json.loads(request.data)
+	except ValueError:
+		return 'expected a json list of commands', 400
+	stopOnError = True
+	if isinstance(requestData, dict):
+		stopOnError = requestData.get('stopOnError', True)
+		requestData = requestData.get('commands')
+	if not isinstance(requestData, list) or not all([isinstance(command, list) and command and isinstance(command[0], basestring) for command in requestData]):
+		return 'expected a list of commands, each a list starting with the command name', 400
+	if not isinstance(stopOnError, bool):
+		return 'stopOnError must be true or false', 400
+	return jsonify({'results' : sculpture.doCommands(requestData, stopOnError)})
+
 
 @flaskApp.route("/dataStream")
 def subscribe():
-	def gen():
-		q = Queue()
-		serverSentEventStreams.append(q)
+	needsResync = 'Last-Event-ID' in request.headers # a reconnecting client missed events
+	def gen(): # the subscriber only exists while this runs, so a client that's gone before it starts leaves nothing behind
+		subscriber = eventBroadcaster.subscribe(needsResync)
 		try:
-			while True:
-				result = q.get()
-				ev = ServerSentEvent(str(result))
-				yield ev.encode()
-		except GeneratorExit:
-			serverSentEventStreams.remove(q)
+			yield EventBroadcaster.keepAliveEvent # opens the stream at once, a client that has already gone fails here
+			while not subscriber.evicted:
+				if not subscriber.wake.wait(eventBroadcaster.keepAliveInterval):
+					yield EventBroadcaster.keepAliveEvent
+					continue
+				subscriber.wake.clear()
+				events = subscriber.takeEvents()
+				if events:
+					yield events
+		finally:
+			eventBroadcaster.unsubscribe(subscriber)
 	return Response(gen(), mimetype="text/event-stream")
 
+@flaskApp.route("/dataStream/stats")
+def dataStreamStats():
+	return jsonify(eventBroadcaster.getCurrentStateData())
+
+@flaskApp.route("/outputStream")
+def outputStream():
+	websocket = request.environ.get('wsgi.websocket')
+	if not websocket:
+		return 'expected a websocket connection', 400
+	client = frameBroadcaster.addClient(websocket)
+	sender = gevent.spawn(client.run)
+	try:
+		while True:
+			message = websocket.receive()
+			if message is None:
+				break
+			try:
+				subscription = json.loads(message)
+			except ValueError:
+				subscription = False
+			if not (isinstance(subscription, dict) and (subscription.get('modules') is None or isinstance(subscription['modules'], list) and all([isinstance(moduleId, basestring) for moduleId in subscription['modules']]))):
+				client.put(json.dumps({'error' : 'expected {"modules" : [moduleId, ...]} or {"modules" : null}'}), False)
+				continue
+			frameBroadcaster.setSubscription(client, subscription.get('modules'))
+	finally:
+		frameBroadcaster.removeClient(client)
+		sender.kill()
+	return ''
+
+@flaskApp.route("/outputStream/stats")
+def outputStreamStats():
+	return jsonify(frameBroadcaster.getCurrentStateData())
+
 # Testing commands
 # sculpture.loadSculpture('tympani')
-# app.messenger.addBinding('outputChanged', sendNewOutputState, ('outputChanged',))
-# app.messenger.addBinding('log', sendNewOutputState, ('log',))
 # sculpture.doCommand(['addPattern', 'poofers', 'AllPoof'])
 # sculpture.doCommand(['addPattern', 'poofers', 'Chase'])
 # sculpture.doCommand(['addGlobalInput', {'type' : 'pulse', 'subType' : 'audio'}])
@@ -103,7 +369,10 @@ if __name__ == '__main__':
 			    help='port for webserver to listen on')
 	args = parser.parse_args()
 	flaskApp.debug = True
-	server = WSGIServer(("", args.port), flaskApp)
+	if WebSocketHandler:
+		server = WSGIServer(("", args.port), flaskApp, handler_class = WebSocketHandler)
+	else:
+		server = WSGIServer(("", args.port), flaskApp)
 	try:
 		print 'starting server on localhost:%s' % args.port
 		server.serve_forever()
@@ -12,6 +12,9 @@ function convertRGBTupleToRGBString(tuple) {
 
 
 function handleDataStreamEvent(data){
+	if (data.resync){ // events were dropped on the way, so start again from the full state
+		reloadData();
+	}
 	if (data.log){
 		$.each(data.log, function(logIndex, logItem){
 			$('#logDiv').prepend(logItem + '<br>');
@@ -576,7 +579,7 @@ function buildInputControls(inputInstanceId, inputData){
 						$('#' + inputId + '_container').append($('#choiceTextTemplate').render(templateData));
 						$('#' + inputId + ' .choiceInputItem').button().click(function(){
 							parts = this.id.split('_');
-							doCommand(['setInputValue', parseInt(parts[0]), parts[1], settingIndex]);
+							doSetInputValue(parts[0], parts[1], settingIndex);
 						});
 						$('#' + inputId + '_outerContainer').removeClass('ui-widget-content');
 
@@ -589,7 +592,7 @@ function buildInputControls(inputInstanceId, inputData){
 				case 'pulse':
 					$('#' + inputId + '_container').append($('#buttonTemplate').render(templateData));
 					$('#' + inputId).button().click(function(e){
-						doCommand(['setInputValue', parseInt(inputInstanceId), true, settingIndex]);
+						doSetInputValue(inputInstanceId, true, settingIndex);
 					});
 				break;
 				case 'toggle':
@@ -678,6 +681,13 @@ function showInput(parentId, parentConfigData, inputChannelId){
 					var parts = this.id.split('_');
 					showRebindDialog(parts[0], parts[1]=='mainInput'?false:parts[1], parts[2]);
 				});
+				if (inputData.shared && inputData.useCount > 1 && parentId.split('_')[1] != 'mainInput'){
+					$(id + ' .inputSubOutputWrapper').append('<button id="' + parentId + '_' + inputChannelId + '_unshareButton" class="rebindButton">Unshare</button>');
+					$('#' + parentId + '_' + inputChannelId + '_unshareButton').button().click(function(e){
+						var parts = this.id.split('_');
+						doCommand(['reassignPatternInputToCopy', parts[0], parts[1], parts[2]]);
+					});
+				}
 			}
 		});
 	}
@@ -728,11 +738,22 @@ function addPattern(moduleId){
 }
 function setInputValue(inputInstanceId, settingIndex){
 	htmlId = '#inputInstance' + inputInstanceId + '_input' + settingIndex;
-	doCommand(['setInputValue', parseInt(inputInstanceId), parseInt($(htmlId).val()), parseInt(settingIndex)]);
+	doSetInputValue(inputInstanceId, parseInt($(htmlId).val()), parseInt(settingIndex));
 }
 function setInputToggle(inputInstanceId, settingIndex){
 	htmlId = '#inputInstance' + inputInstanceId + '_input' + settingIndex;
-	doCommand(['setInputValue', parseInt(inputInstanceId), $(htmlId).is(":checked"), parseInt(settingIndex)]);
+	doSetInputValue(inputInstanceId, $(htmlId).is(":checked"), parseInt(settingIndex));
+}
+function doSetInputValue(inputInstanceId, value, settingIndex){ // shared inputs are changed through the pattern being shown, which gets its own copy
+	inputData = allSculptureData.inputs[inputInstanceId];
+	moduleId = currentView.activeModule;
+	patternInstanceId = moduleId && currentView.activeSections[moduleId];
+	if (inputData.shared && inputData.useCount > 1 && moduleId != 'main' && patternInstanceId && allSculptureData.modules[moduleId].patterns && allSculptureData.modules[moduleId].patterns[patternInstanceId]){
+		doCommand(['setPatternInputValue', moduleId, patternInstanceId, parseInt(inputInstanceId), value, settingIndex]);
+	}
+	else {
+		doCommand(['setInputValue', parseInt(inputInstanceId), value, settingIndex]);
+	}
 }
 function updateStatusDisplay(){
 	if (allSculptureData.activeSculptureId){
@@ -1,8 +1,6 @@
-
-import OSC
-c = OSC.OSCClient()
+import socket
+from Inputs.Osc import encodeOscMessage, encodeOscBundle
+c = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 c.connect(("127.0.0.2", 8000))
-bundle = OSC.OSCBundle()
-bundle.append({'addr' : '/1/button1', 'args' : ['1']})
-bundle.setAddress('/1/button1')
+bundle = encodeOscBundle([encodeOscMessage('/1/button1', ['1'])])
 c.send(bundle)